@@ -0,0 +1,288 @@
+"""
+Нагрузочный прогон горячих хендлеров без Telegram: /start, заявка на вступление,
+"Проверить подписку" и рассылка. Апдейты синтетические и идут через Dispatcher.feed_update
+(с очередями update_lanes, буферами записи и лимитером Bot API, как в боте),
+запросы к Bot API отвечает заглушка с заданной задержкой.
+
+    python benchmarks/bench_handlers.py [--users 1000] [--latency 0.02] [--database-url URL]
+    python benchmarks/bench_handlers.py --save-baseline
+
+По умолчанию база — временный файл SQLite; для локального Postgres передайте --database-url
+(таблицы будут созданы, пользователи бенчмарка — добавлены в неё).
+Лимиты Bot API (API_RATE, BROADCAST_RATE и т.д.) подняты, чтобы мерить сам код; --limits оставляет
+значения из окружения / config.py.
+
+Для каждого сценария: задержка апдейта p50/p95/p99 (от feed_update до конца хендлера,
+у рассылки — одной отправки), апдейтов/сообщений в секунду и пиковый RSS процесса.
+Результат сравнивается с benchmarks/baseline.json; при ухудшении больше --tolerance код выхода 1.
+"""
+import argparse
+import asyncio
+import datetime
+import json
+import logging
+import os
+import resource
+import statistics
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, ".")
+
+BASELINE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "baseline.json")
+ADMIN_ID = 1
+USER_ID_BASE = 10_000_000
+TARGET_CHANNEL_ID = -1001000000000
+CHANNEL_IDS = [-1001000000001, -1001000000002, -1001000000003]
+SCENARIOS = ("start", "join_request", "check_subscription", "broadcast")
+# Метрики, где больше — лучше; у остальных (задержки, память) лучше меньше
+HIGHER_IS_BETTER = {"per_sec"}
+# Лимиты, которые бенчмарк поднимает без --limits
+UNLIMITED_ENV = {
+    "API_RATE": "100000",
+    "API_PRIVATE_CHAT_RATE": "100000",
+    "API_GROUP_CHAT_RATE": "100000",
+    "API_CHAT_BURST": "100000",
+    "BROADCAST_RATE": "100000",
+}
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--users", type=int, default=1000, help="пользователей (апдейтов) на сценарий")
+    parser.add_argument("--latency", type=float, default=0.02, help="задержка ответа заглушки Bot API, сек")
+    parser.add_argument("--database-url", help="по умолчанию — временный файл SQLite")
+    parser.add_argument("--limits", action="store_true", help="не поднимать лимиты Bot API и рассылки")
+    parser.add_argument("--baseline", default=BASELINE_PATH)
+    parser.add_argument("--save-baseline", action="store_true", help="записать результат как новый baseline")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="допустимое ухудшение метрики (доля)")
+    return parser.parse_args()
+
+
+def configure_env(args, tmpdir: str):
+    """config.py читает окружение при импорте, поэтому всё выставляется до импорта бота"""
+    os.environ["DATABASE_URL"] = args.database_url or f"sqlite:///{os.path.join(tmpdir, 'bench.db')}"
+    os.environ["BOT_TOKEN"] = "42:BENCHMARK"
+    os.environ["ADMIN_ID"] = str(ADMIN_ID)
+    os.environ["TEMPLATES_RELOAD_INTERVAL"] = "0"
+    if not args.limits:
+        os.environ.update(UNLIMITED_ENV)
+
+
+def peak_rss_mb() -> float:
+    # ru_maxrss в Linux — в килобайтах
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def summarize(latencies: list[float], count: int, elapsed: float) -> dict:
+    q = statistics.quantiles(latencies, n=100) if len(latencies) > 1 else latencies * 99
+    return {
+        "p50_ms": round(q[49] * 1000, 2),
+        "p95_ms": round(q[94] * 1000, 2),
+        "p99_ms": round(q[98] * 1000, 2),
+        "per_sec": round(count / elapsed, 1),
+        "peak_rss_mb": round(peak_rss_mb(), 1),
+    }
+
+
+def compare(results: dict, baseline: dict, tolerance: float) -> list[str]:
+    """Печатает изменение относительно baseline и возвращает список ухудшений больше tolerance"""
+    regressions = []
+    for scenario, metrics in results.items():
+        base = baseline.get(scenario)
+        if not base:
+            continue
+        for name, value in metrics.items():
+            old = base.get(name)
+            if not old:
+                continue
+            change = (value - old) / old
+            worse = -change if name in HIGHER_IS_BETTER else change
+            mark = "  ⚠️" if worse > tolerance else ""
+            print(f"  {scenario:<20} {name:<12} {old:>10} -> {value:>10} ({change:+.0%}){mark}")
+            if worse > tolerance:
+                regressions.append(f"{scenario}.{name}")
+    return regressions
+
+
+async def run(args) -> dict:
+    from aiogram import Bot
+    from aiogram.client.session.base import BaseSession
+    from aiogram.types import (
+        CallbackQuery, Chat, ChatJoinRequest, ChatMemberMember, Message, Update, User
+    )
+
+    import loader
+    from database.database import async_session, Channel, TargetChannel
+    from services.broadcast_manager import broadcast_manager
+    from services.dispatch import update_lanes
+    from services.flood_control import flood_governor
+    from services.write_buffer import write_buffer
+
+    class StubSession(BaseSession):
+        """Bot API без сети: отвечает правдоподобными объектами через latency секунд"""
+
+        def __init__(self, latency: float):
+            super().__init__()
+            self.latency = latency
+            self.calls: dict[str, int] = {}
+
+        async def make_request(self, bot, method, timeout=None):
+            name = method.__api_method__
+            self.calls[name] = self.calls.get(name, 0) + 1
+            if self.latency:
+                await asyncio.sleep(self.latency)
+            if name == "getChatMember":
+                return ChatMemberMember(user=User(id=method.user_id, is_bot=False, first_name="user"))
+            if name == "getMe":
+                return User(id=42, is_bot=True, first_name="bot")
+            if name.startswith(("send", "edit", "forward", "copy")):
+                chat_id = method.chat_id if isinstance(getattr(method, "chat_id", None), int) else ADMIN_ID
+                return Message(message_id=1, date=datetime.datetime.now(), chat=Chat(id=chat_id, type="private"),
+                               text=getattr(method, "text", None) or "-")
+            return True
+
+        async def stream_content(self, *args, **kwargs):
+            yield b""
+
+        async def close(self):
+            pass
+
+    # Замер отправок рассылки: внешний request-middleware, т.е. с ожиданием в лимитере
+    send_latencies: list[float] = []
+
+    async def send_timer(make_request, bot, method):
+        started = time.perf_counter()
+        try:
+            return await make_request(bot, method)
+        finally:
+            if method.__api_method__ == "sendMessage" and method.chat_id != ADMIN_ID:
+                send_latencies.append(time.perf_counter() - started)
+
+    session = StubSession(args.latency)
+    bot = Bot("42:BENCHMARK", session=session)
+    bot.session.middleware(send_timer)
+    bot.session.middleware(flood_governor)
+
+    # Конец обработки апдейта: inner-middleware выполняется уже внутри очереди update_lanes
+    fed: dict[int, float] = {}
+    finished: dict[int, float] = {}
+
+    async def update_timer(handler, event, data):
+        try:
+            return await handler(event, data)
+        finally:
+            finished[event.update_id] = time.perf_counter()
+
+    loader.dp.update.middleware(update_timer)
+
+    await loader.init_database()
+    async with async_session() as db:
+        if not await db.get(TargetChannel, 1):
+            db.add(TargetChannel(channel_id=TARGET_CHANNEL_ID, name="Бенчмарк", link="https://t.me/+bench"))
+            db.add_all([Channel(channel_id=channel_id, name=f"Канал {n}", link=f"https://t.me/bench{n}")
+                        for n, channel_id in enumerate(CHANNEL_IDS)])
+            await db.commit()
+    await loader.start_services(bot, resume_broadcasts=False)
+
+    update_ids = iter(range(1, 10 ** 9))
+    now = datetime.datetime.now()
+
+    def user(n: int) -> User:
+        return User(id=USER_ID_BASE + n, is_bot=False, first_name=f"Пользователь {n}", username=f"bench_{n}")
+
+    def message(uid: int, text: str) -> Update:
+        return Update(update_id=next(update_ids), message=Message(
+            message_id=1, date=now, chat=Chat(id=uid, type="private"),
+            from_user=User(id=uid, is_bot=False, first_name="Админ"), text=text
+        ))
+
+    def callback(from_user: User, data: str) -> Update:
+        return Update(update_id=next(update_ids), callback_query=CallbackQuery(
+            id=str(from_user.id), from_user=from_user, chat_instance="bench", data=data,
+            message=Message(message_id=1, date=now, chat=Chat(id=from_user.id, type="private"), text="-")
+        ))
+
+    builders = {
+        "start": lambda n: Update(update_id=next(update_ids), message=Message(
+            message_id=1, date=now, chat=Chat(id=USER_ID_BASE + n, type="private"), from_user=user(n), text="/start"
+        )),
+        "join_request": lambda n: Update(update_id=next(update_ids), chat_join_request=ChatJoinRequest(
+            chat=Chat(id=TARGET_CHANNEL_ID, type="channel"), from_user=user(n),
+            user_chat_id=USER_ID_BASE + n, date=now
+        )),
+        "check_subscription": lambda n: callback(user(n), "check_subscription"),
+    }
+
+    async def feed_all(updates: list[Update]) -> dict:
+        started = time.perf_counter()
+        for update in updates:
+            fed[update.update_id] = time.perf_counter()
+            await loader.dp.feed_update(bot, update)
+        await update_lanes.drain()
+        elapsed = time.perf_counter() - started
+        latencies = [finished[u.update_id] - fed[u.update_id] for u in updates]
+        return summarize(latencies, len(updates), elapsed)
+
+    results = {}
+    for scenario, build in builders.items():
+        results[scenario] = await feed_all([build(n) for n in range(args.users)])
+        # Записи /start и заявок должны попасть в БД до следующего сценария
+        await write_buffer.flush()
+
+    # Рассылка всем, кто нажал /start: тот же путь, что у админа в боте
+    admin = User(id=ADMIN_ID, is_bot=False, first_name="Админ")
+    for update in (callback(admin, "announcement"), callback(admin, "broadcast_text_only"),
+                   message(ADMIN_ID, "Бенчмарк рассылки, {first_name}!")):
+        await loader.dp.feed_update(bot, update)
+        await update_lanes.drain()
+    # Считаем только отправки самой рассылки, без ответов на /start и заявки
+    send_latencies.clear()
+    started = time.perf_counter()
+    await loader.dp.feed_update(bot, callback(admin, "send_broadcast"))
+    await update_lanes.drain()
+    await asyncio.gather(*(running.task for running in list(broadcast_manager.jobs.values())))
+    results["broadcast"] = summarize(send_latencies, len(send_latencies), time.perf_counter() - started)
+
+    await loader.stop_services()
+    await bot.session.close()
+    print("Запросов к заглушке Bot API:", dict(sorted(session.calls.items())))
+    return results
+
+
+def main():
+    args = parse_args()
+    logging.basicConfig(level=logging.WARNING)
+    with tempfile.TemporaryDirectory() as tmpdir:
+        configure_env(args, tmpdir)
+        results = asyncio.run(run(args))
+
+    print(f"\nПользователей: {args.users}, задержка Bot API: {args.latency * 1000:.0f} мс")
+    for scenario in SCENARIOS:
+        m = results[scenario]
+        print(f"  {scenario:<20} p50 {m['p50_ms']:>8} мс  p95 {m['p95_ms']:>8} мс  p99 {m['p99_ms']:>8} мс  "
+              f"{m['per_sec']:>9}/с  RSS {m['peak_rss_mb']} МБ")
+
+    params = {"users": args.users, "latency": args.latency, "limits": args.limits}
+    if args.save_baseline:
+        with open(args.baseline, "w", encoding="utf-8") as f:
+            json.dump({"params": params, "results": results}, f, ensure_ascii=False, indent=2)
+        print(f"\nBaseline записан в {args.baseline}")
+        return
+    if not os.path.exists(args.baseline):
+        print("\nBaseline нет — запустите с --save-baseline")
+        return
+    with open(args.baseline, encoding="utf-8") as f:
+        baseline = json.load(f)
+    if baseline.get("params") != params:
+        print(f"\n⚠️ Baseline снят с другими параметрами: {baseline.get('params')}")
+    print("\nСравнение с baseline:")
+    regressions = compare(results, baseline["results"], args.tolerance)
+    if regressions:
+        print(f"\n❌ Ухудшение больше {args.tolerance:.0%}: {', '.join(regressions)}")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
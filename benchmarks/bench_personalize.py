@@ -0,0 +1,53 @@
+"""
+Скорость персонализации текста рассылки: рендер разобранного шаблона для получателя.
+
+    python benchmarks/bench_personalize.py [количество рендеров]
+
+Цель — не меньше 100 000 рендеров в секунду; при меньшем значении скрипт завершается с кодом 1.
+"""
+import sys
+import time
+from collections import namedtuple
+
+sys.path.insert(0, ".")
+from services.personalize import compile_template  # noqa: E402
+
+TARGET_RENDERS_PER_SEC = 100_000
+
+Row = namedtuple("Row", "id user_id is_active first_name username")
+
+TEMPLATE = (
+    "👋 <b>{first_name}</b>, привет!\n\n"
+    "Мы подготовили для тебя подборку — <a href=\"https://t.me/example\">переходи в канал</a>.\n"
+    "Твой ник: @{username}\n\n" + "Здесь обычный текст рассылки, с <i>разметкой</i> и ссылками. " * 8
+)
+
+
+def make_rows(count: int) -> list[Row]:
+    names = ["Иван", "Anna & Co", "<Мария>", "Пётр", "😀 Smile", ""]
+    return [
+        Row(i, 100000 + i, True, names[i % len(names)], f"user_{i}" if i % 3 else "None")
+        for i in range(count)
+    ]
+
+
+def bench(renders: int) -> float:
+    template = compile_template(TEMPLATE)
+    rows = make_rows(10_000)
+    started = time.perf_counter()
+    for i in range(renders):
+        template.render_for(rows[i % len(rows)])
+    return renders / (time.perf_counter() - started)
+
+
+def main():
+    renders = int(sys.argv[1]) if len(sys.argv) > 1 else 500_000
+    bench(10_000)  # прогрев
+    speed = bench(renders)
+    print(f"Рендеров: {renders}, скорость: {speed:,.0f}/с (цель {TARGET_RENDERS_PER_SEC:,}/с)")
+    if speed < TARGET_RENDERS_PER_SEC:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,135 @@
+"""
+Сравнение рендера text + entities -> HTML: services.render и прежние реализации
+(entities_to_html с нарезкой UTF-16 на каждую сущность и построчный рендер рассылки в admin_router).
+
+    python benchmarks/bench_render.py [бюджет вызовов]
+
+Прежние реализации скопированы сюда без изменений, только для сравнения.
+"""
+import html
+import re
+import sys
+import time
+
+sys.path.insert(0, ".")
+from aiogram.types import MessageEntity  # noqa: E402
+
+from services.render import entities_to_html  # noqa: E402
+
+
+def legacy_entities_to_html(text: str, entities: list | None) -> str:
+    if not entities:
+        return html.escape(text)
+
+    html_parts = []
+    last_byte_index = 0
+    encoded = text.encode('utf-16-le')
+    for ent in entities:
+        start_b = ent["offset"] * 2
+        end_b = (ent["offset"] + ent["length"]) * 2
+
+        before = encoded[last_byte_index:start_b].decode('utf-16-le', errors='ignore')
+        entity_text = encoded[start_b:end_b].decode('utf-16-le', errors='ignore')
+        html_parts.append(html.escape(before))
+
+        t = ent["type"]
+        if t == "text_link" and ent.get("url"):
+            html_parts.append(f'<a href="{html.escape(ent["url"], quote=True)}">{html.escape(entity_text)}</a>')
+        elif t == "url":
+            html_parts.append(f'<a href="{html.escape(entity_text)}">{html.escape(entity_text)}</a>')
+        elif t == "bold":
+            html_parts.append(f"<b>{html.escape(entity_text)}</b>")
+        elif t == "italic":
+            html_parts.append(f"<i>{html.escape(entity_text)}</i>")
+        elif t == "underline":
+            html_parts.append(f"<u>{html.escape(entity_text)}</u>")
+        elif t == "strikethrough":
+            html_parts.append(f"<s>{html.escape(entity_text)}</s>")
+        elif t == "code":
+            html_parts.append(f"<code>{html.escape(entity_text)}</code>")
+        else:
+            html_parts.append(html.escape(entity_text))
+
+        last_byte_index = end_b
+
+    rest = encoded[last_byte_index:].decode('utf-16-le', errors='ignore')
+    html_parts.append(html.escape(rest))
+
+    return "".join(html_parts)
+
+
+def legacy_broadcast_html(text: str, entities: list[MessageEntity] | None) -> str:
+    html_text = ""
+
+    if entities:
+        prev_end = 0
+        for ent in entities:
+            start = ent.offset
+            end = ent.offset + ent.length
+
+            if start > 0 and re.match(r"[А-Яа-яЁё]", text[start - 1:start + 1]):
+                start -= 1
+
+            html_text += text[prev_end:start]
+
+            entity_text = ent.extract_from(text)
+            if ent.type in ("url", "text_link"):
+                url = ent.url if ent.type == "text_link" else entity_text
+                html_text += f'<a href="{url}">{entity_text}</a>'
+            else:
+                html_text += entity_text
+
+            prev_end = end
+
+        html_text += text[prev_end:]
+    else:
+        html_text = text
+
+    return html_text
+
+
+def make_message(paragraphs: int) -> tuple[str, list[dict]]:
+    """Текст с кириллицей и эмодзи и непересекающимися сущностями (прежние реализации других не умеют)"""
+    text, entities = "", []
+    kinds = ["bold", "italic", "text_link", "underline", "code", "strikethrough"]
+    for n in range(paragraphs):
+        offset = len(text.encode("utf-16-le")) // 2
+        word = f"Раздел {n} 🔥"
+        ent = {"type": kinds[n % len(kinds)], "offset": offset, "length": len(word.encode("utf-16-le")) // 2}
+        if ent["type"] == "text_link":
+            ent["url"] = f"https://t.me/example?start={n}"
+        entities.append(ent)
+        text += word + " — обычный текст абзаца <с символами> & ссылками, 😀 эмодзи и кириллицей.\n"
+    return text, entities
+
+
+def bench(func, text, entities, repeat: int) -> float:
+    """Лучшее из трёх прогонов, мкс на вызов"""
+    best = float("inf")
+    for _ in range(3):
+        started = time.perf_counter()
+        for _ in range(repeat):
+            func(text, entities)
+        best = min(best, time.perf_counter() - started)
+    return best / repeat * 1e6
+
+
+def main():
+    # Число вызовов на размер: budget / число сущностей, чтобы большие сообщения не шли минутами
+    budget = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+    for paragraphs in (5, 50, 500):
+        text, entities = make_message(paragraphs)
+        aiogram_entities = [MessageEntity(**ent) for ent in entities]
+        repeat = max(5, budget // paragraphs)
+        results = {
+            "services.render": bench(entities_to_html, text, entities, repeat),
+            "прежний entities_to_html": bench(legacy_entities_to_html, text, entities, repeat),
+            "прежний рендер рассылки": bench(legacy_broadcast_html, text, aiogram_entities, repeat),
+        }
+        print(f"Сущностей: {paragraphs}, символов: {len(text)}")
+        for name, micros in results.items():
+            print(f"  {name:<26} {micros:10.1f} мкс")
+
+
+if __name__ == "__main__":
+    main()
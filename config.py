@@ -8,6 +8,85 @@ BOT_TOKEN = os.getenv("BOT_TOKEN")
 ADMIN_ID = int(os.getenv("ADMIN_ID", "0"))
 DATABASE_URL = os.getenv("DATABASE_URL")
 
+# Режим получения апдейтов: polling или webhook
+BOT_MODE = os.getenv("BOT_MODE", "polling")
+# Публичный адрес для setWebhook; если пусто — сервер поднимается без регистрации (локальная отладка)
+WEBHOOK_BASE_URL = os.getenv("WEBHOOK_BASE_URL", "")
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "/webhook")
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET", "")
+WEBAPP_HOST = os.getenv("WEBAPP_HOST", "0.0.0.0")
+WEBAPP_PORT = int(os.getenv("WEBAPP_PORT", "8080"))
+# Сколько апдейтов обрабатывается одновременно (апдейты одного пользователя — всегда по очереди)
+# и сколько может ждать в очередях, прежде чем приём новых апдейтов приостановится
+UPDATE_WORKERS = int(os.getenv("UPDATE_WORKERS", "50"))
+UPDATE_MAX_PENDING = int(os.getenv("UPDATE_MAX_PENDING", "1000"))
+# Число процессов-обработчиков в режиме polling (апдейты шардируются по id пользователя), 1 — без шардирования
+WORKERS = int(os.getenv("WORKERS", "1"))
 
+# Интервал перезагрузки кэша шаблонов из БД (сек), 0 — выключено.
+# Нужен, когда несколько процессов бота работают с одной базой.
+TEMPLATES_RELOAD_INTERVAL = float(os.getenv("TEMPLATES_RELOAD_INTERVAL", "0"))
 
+# Проверка подписки: сколько get_chat_member выполнять одновременно и таймаут одного вызова (сек)
+SUBSCRIPTION_CHECK_CONCURRENCY = int(os.getenv("SUBSCRIPTION_CHECK_CONCURRENCY", "8"))
+SUBSCRIPTION_CHECK_TIMEOUT = float(os.getenv("SUBSCRIPTION_CHECK_TIMEOUT", "5"))
+# Сколько секунд повторное нажатие "Проверить подписку" получает результат последней проверки
+SUBSCRIPTION_CHECK_COOLDOWN = float(os.getenv("SUBSCRIPTION_CHECK_COOLDOWN", "3"))
 
+# Локальный кэш подписок: TTL подтверждённой подписки, TTL отрицательного ответа API (сек)
+# и максимальное число записей в памяти
+MEMBERSHIP_TTL = float(os.getenv("MEMBERSHIP_TTL", "600"))
+MEMBERSHIP_NEGATIVE_TTL = float(os.getenv("MEMBERSHIP_NEGATIVE_TTL", "10"))
+MEMBERSHIP_MAX_ENTRIES = int(os.getenv("MEMBERSHIP_MAX_ENTRIES", "200000"))
+
+# Общий лимитер Bot API: отправок сообщений в секунду на бота, сообщений в секунду в личный чат и в группу/канал,
+# запас подряд идущих сообщений в один чат и число повторов после 429.
+# Лимитер живёт в процессе: при WORKERS > 1 каждый воркер получает API_RATE / WORKERS
+API_RATE = float(os.getenv("API_RATE", "30"))
+API_PRIVATE_CHAT_RATE = float(os.getenv("API_PRIVATE_CHAT_RATE", "1"))
+API_GROUP_CHAT_RATE = float(os.getenv("API_GROUP_CHAT_RATE", "0.33"))
+API_CHAT_BURST = float(os.getenv("API_CHAT_BURST", "3"))
+API_MAX_RETRIES = int(os.getenv("API_MAX_RETRIES", "3"))
+
+# HTTP-сессия Bot API: размер пула соединений, keep-alive простаивающего соединения (сек), кэш DNS (сек)
+# и таймауты (сек): по умолчанию, для коротких запросов (get_chat_member, ответ на кнопку) и для отправки медиа
+API_POOL_SIZE = int(os.getenv("API_POOL_SIZE", "100"))
+API_KEEPALIVE = float(os.getenv("API_KEEPALIVE", "60"))
+API_DNS_TTL = int(os.getenv("API_DNS_TTL", "3600"))
+API_TIMEOUT = float(os.getenv("API_TIMEOUT", "20"))
+API_FAST_TIMEOUT = float(os.getenv("API_FAST_TIMEOUT", "5"))
+API_MEDIA_TIMEOUT = float(os.getenv("API_MEDIA_TIMEOUT", "60"))
+
+# Рассылка: сообщений в секунду (лимит Telegram ~30/с на бота) и число параллельных отправителей
+BROADCAST_RATE = float(os.getenv("BROADCAST_RATE", "25"))
+BROADCAST_WORKERS = int(os.getenv("BROADCAST_WORKERS", "20"))
+# Как часто (в получателях) сохранять прогресс рассылки в БД
+BROADCAST_CHECKPOINT_EVERY = int(os.getenv("BROADCAST_CHECKPOINT_EVERY", "100"))
+# Отложенные рассылки: как часто проверять расписание (сек) и часовой пояс админа (смещение от UTC, ч)
+SCHEDULER_INTERVAL = float(os.getenv("SCHEDULER_INTERVAL", "30"))
+SCHEDULE_UTC_OFFSET = float(os.getenv("SCHEDULE_UTC_OFFSET", "3"))
+# Как часто обновлять сообщение с прогрессом рассылки у админа (сек)
+BROADCAST_PROGRESS_INTERVAL = float(os.getenv("BROADCAST_PROGRESS_INTERVAL", "5"))
+# Пакетная запись is_active во время рассылки: по размеру пачки или по времени (сек)
+STATUS_FLUSH_SIZE = int(os.getenv("STATUS_FLUSH_SIZE", "500"))
+STATUS_FLUSH_INTERVAL = float(os.getenv("STATUS_FLUSH_INTERVAL", "5"))
+# Повторы отправок после временных ошибок (сеть, 5xx): число попыток, начальная и максимальная задержка (сек)
+# и сколько недоставленных хранить для просмотра админом
+RETRY_MAX_ATTEMPTS = int(os.getenv("RETRY_MAX_ATTEMPTS", "5"))
+RETRY_BASE_DELAY = float(os.getenv("RETRY_BASE_DELAY", "2"))
+RETRY_MAX_DELAY = float(os.getenv("RETRY_MAX_DELAY", "300"))
+RETRY_DEAD_LETTER_SIZE = int(os.getenv("RETRY_DEAD_LETTER_SIZE", "200"))
+# Размер страницы при чтении аудитории рассылки из БД
+AUDIENCE_CHUNK_SIZE = int(os.getenv("AUDIENCE_CHUNK_SIZE", "1000"))
+# Через сколько дней неактивного пользователя можно снова попробовать в рассылке с перепроверкой
+REPROBE_INTERVAL_DAYS = int(os.getenv("REPROBE_INTERVAL_DAYS", "30"))
+
+# Отложенная запись пользователей (/start) и заявок: размер пачки и интервал сброса (сек)
+WRITE_BUFFER_FLUSH_SIZE = int(os.getenv("WRITE_BUFFER_FLUSH_SIZE", "500"))
+WRITE_BUFFER_FLUSH_INTERVAL = float(os.getenv("WRITE_BUFFER_FLUSH_INTERVAL", "1"))
+
+# Хранилище FSM в БД: через сколько секунд бездействия состояние диалога удаляется,
+# интервал пакетной записи (сек) и максимум записей в кэше чтения
+FSM_STATE_TTL = float(os.getenv("FSM_STATE_TTL", "86400"))
+FSM_FLUSH_INTERVAL = float(os.getenv("FSM_FLUSH_INTERVAL", "1"))
+FSM_CACHE_MAX_ENTRIES = int(os.getenv("FSM_CACHE_MAX_ENTRIES", "10000"))
@@ -1,9 +1,14 @@
 import logging
+from contextlib import asynccontextmanager
+
 from sqlalchemy import (
-    Column, Integer, String, BigInteger, create_engine, Boolean, JSON
+    Column, Integer, String, BigInteger, Boolean, Float, JSON, DateTime, ForeignKey, Index, select, func
 )
-from sqlalchemy.orm import declarative_base, sessionmaker
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker, AsyncSession
+from sqlalchemy.orm import declarative_base
 from config import DATABASE_URL
+from database.migrations import migrate
 
 # Логгер
 logger = logging.getLogger(__name__)
@@ -18,11 +23,16 @@ class User(Base):
     user_id = Column(BigInteger, unique=True, nullable=False)
     username = Column(String(100), nullable=False, server_default="None")  # @username
     first_name = Column(String(100), nullable=False)
-    is_active = Column(Boolean, nullable=False, default=True)
+    is_active = Column(Boolean, nullable=False, default=True, index=True)
+    created_at = Column(DateTime, nullable=True, default=func.now(), index=True)  # дата регистрации (/start)
+    probed_at = Column(DateTime, nullable=True)  # когда рассылка последний раз меняла is_active
 
 
 class PendingRequest(Base):
     __tablename__ = "pending_requests"
+    __table_args__ = (
+        Index("ux_pending_requests_user_chat", "user_id", "chat_id", unique=True),
+    )
     id = Column(Integer, primary_key=True)
     user_id = Column(BigInteger, nullable=False)
     chat_id = Column(BigInteger, nullable=False)
@@ -53,66 +63,183 @@ class Message(Base):
     entities = Column(JSON, nullable=True)
 
 
-engine = create_engine(DATABASE_URL, echo=False)
+class BroadcastJob(Base):
+    __tablename__ = 'broadcast_jobs'
+    id = Column(Integer, primary_key=True)
+    kind = Column(String(20), nullable=False)  # send / forward
+    payload = Column(JSON, nullable=False)
+    status = Column(String(20), nullable=False, default="running")  # scheduled / running / paused / cancelled / done / failed
+    rate = Column(Float, nullable=True)  # сообщений в секунду, None — BROADCAST_RATE
+    scheduled_at = Column(DateTime, nullable=True)  # время запуска отложенной рассылки (UTC)
+    spread_minutes = Column(Integer, nullable=True)  # растянуть отправку на N минут
+    cursor = Column(Integer, nullable=False, default=0)  # последний обработанный users.id
+    total = Column(Integer, nullable=False, default=0)
+    success = Column(Integer, nullable=False, default=0)
+    failed = Column(Integer, nullable=False, default=0)
+    admin_chat_id = Column(BigInteger, nullable=True)
+    created_at = Column(DateTime, nullable=False, server_default=func.now())
+    finished_at = Column(DateTime, nullable=True)
+
+
+class BroadcastDelivery(Base):
+    """Неудачные доставки рассылки (успешные покрываются курсором задачи)"""
+    __tablename__ = 'broadcast_deliveries'
+    id = Column(Integer, primary_key=True)
+    job_id = Column(Integer, ForeignKey('broadcast_jobs.id', ondelete="CASCADE"), nullable=False, index=True)
+    user_id = Column(BigInteger, nullable=False)
+    error = Column(String(255), nullable=True)
+
+
+class FsmRecord(Base):
+    """Состояния FSM (aiogram): ключ "chat:user[:...]", состояние и данные диалога"""
+    __tablename__ = 'fsm_states'
+    key = Column(String(100), primary_key=True)
+    state = Column(String(100), nullable=True)
+    data = Column(JSON, nullable=True)
+    updated_at = Column(DateTime, nullable=False, index=True)  # для удаления брошенных состояний по TTL
+
+
+def make_async_url(url: str) -> str:
+    """Подставляет асинхронный драйвер в DATABASE_URL (asyncpg для Postgres, aiosqlite для SQLite)"""
+    if url.startswith("postgres://"):
+        url = "postgresql://" + url[len("postgres://"):]
+    if url.startswith("postgresql://") or url.startswith("postgresql+psycopg2://"):
+        return "postgresql+asyncpg://" + url.split("://", 1)[1]
+    if url.startswith("sqlite://"):
+        return "sqlite+aiosqlite://" + url.split("://", 1)[1]
+    return url
 
 
-def init_db():
+engine = create_async_engine(make_async_url(DATABASE_URL), echo=False, pool_pre_ping=True)
+
+SessionLocal = async_sessionmaker(bind=engine, expire_on_commit=False)
+
+
+async def init_db():
     try:
-        Base.metadata.create_all(engine)
+        async with engine.begin() as conn:
+            await conn.run_sync(Base.metadata.create_all)
+            await conn.run_sync(migrate)
         logger.info("✅ Таблицы базы данных успешно созданы или уже существуют")
         return engine
     except Exception as e:
         logger.error(f"❌ Ошибка создания таблиц: {e}")
         raise
 
-SessionLocal = sessionmaker(bind=engine)
 
-def get_db():
-    db = SessionLocal()
+@asynccontextmanager
+async def async_session():
+    """Асинхронная сессия: откатывает транзакцию при ошибке и всегда закрывается"""
+    session: AsyncSession = SessionLocal()
     try:
-        yield db
+        yield session
+    except Exception:
+        await session.rollback()
+        raise
     finally:
-        db.close()
+        await session.close()
+
+
+def insert(table):
+    """INSERT с поддержкой ON CONFLICT для текущего диалекта (Postgres / SQLite)"""
+    if engine.dialect.name == "postgresql":
+        return postgresql.insert(table)
+    return sqlite.insert(table)
+
+
+async def upsert_users(db: AsyncSession, rows: list[dict]):
+    """
+    Один INSERT ... ON CONFLICT (user_id) DO UPDATE на все строки:
+    новые пользователи создаются, у существующих обновляются username/first_name,
+    и пользователь снова считается активным.
+    rows: [{"user_id": ..., "username": ..., "first_name": ...}, ...]
+    """
+    if not rows:
+        return
+    stmt = insert(User).values(rows)
+    stmt = stmt.on_conflict_do_update(
+        index_elements=[User.user_id],
+        set_={
+            "username": stmt.excluded.username,
+            "first_name": stmt.excluded.first_name,
+            "is_active": True,
+        }
+    )
+    await db.execute(stmt)
+
+
+async def add_pending_requests(db: AsyncSession, rows: list[dict]):
+    """
+    INSERT ... ON CONFLICT (user_id, chat_id) DO NOTHING.
+    rows: [{"user_id": ..., "chat_id": ...}, ...]
+    """
+    if not rows:
+        return
+    stmt = insert(PendingRequest).values(rows).on_conflict_do_nothing(
+        index_elements=[PendingRequest.user_id, PendingRequest.chat_id]
+    )
+    await db.execute(stmt)
+
+
+async def upsert_fsm_records(db: AsyncSession, rows: list[dict]):
+    """
+    INSERT ... ON CONFLICT (key) DO UPDATE state/data/updated_at.
+    rows: [{"key": ..., "state": ..., "data": ..., "updated_at": ...}, ...]
+    """
+    if not rows:
+        return
+    stmt = insert(FsmRecord).values(rows)
+    stmt = stmt.on_conflict_do_update(
+        index_elements=[FsmRecord.key],
+        set_={
+            "state": stmt.excluded.state,
+            "data": stmt.excluded.data,
+            "updated_at": stmt.excluded.updated_at,
+        }
+    )
+    await db.execute(stmt)
+
+
+async def get_db():
+    async with async_session() as db:
+        yield db
 
 
-def add_sample_messages():
+async def add_sample_messages():
     """Добавляем стандартные сообщения при первом запуске"""
-    db = SessionLocal()
     try:
-        # Проверяем, есть ли уже сообщения
-        existing_messages = db.query(Message).count()
-        if existing_messages == 0:
-            sample_messages = [
-                Message(
-                    title="Самое первое с командой /start",
-                    text="отправьте команду /start"
-                ),
-                Message(
-                    title="Приветственное",
-                    text="👋 Добро пожаловать в наш бот!\n\nМы рады видеть вас здесь!"
-                ),
-                Message(
-                    title="Ошибка проверки",
-                    text="❌ Не удалось проверить подписку.\n\nПожалуйста, убедитесь что вы подписались на все каналы и попробуйте снова."
-                ),
-                Message(
-                    title="Подписка на канал",
-                    text="✅ Вы успешно подписались на канал!\n\nТеперь у вас есть доступ ко всем материалам."
-                ),
-                Message(
-                    title="Отписка от канала",
-                    text="📤 Вы отписались от канала.\n\nЕсли это произошло случайно, вы можете подписаться снова."
-                )
-            ]
-
-            db.add_all(sample_messages)
-            db.commit()
-            logger.info("✅ Добавлены стандартные сообщения в БД")
-        else:
-            logger.info("✅ Сообщения уже существуют в БД")
+        async with async_session() as db:
+            # Проверяем, есть ли уже сообщения
+            existing_messages = await db.scalar(select(func.count()).select_from(Message))
+            if existing_messages == 0:
+                sample_messages = [
+                    Message(
+                        title="Самое первое с командой /start",
+                        text="отправьте команду /start"
+                    ),
+                    Message(
+                        title="Приветственное",
+                        text="👋 Добро пожаловать в наш бот!\n\nМы рады видеть вас здесь!"
+                    ),
+                    Message(
+                        title="Ошибка проверки",
+                        text="❌ Не удалось проверить подписку.\n\nПожалуйста, убедитесь что вы подписались на все каналы и попробуйте снова."
+                    ),
+                    Message(
+                        title="Подписка на канал",
+                        text="✅ Вы успешно подписались на канал!\n\nТеперь у вас есть доступ ко всем материалам."
+                    ),
+                    Message(
+                        title="Отписка от канала",
+                        text="📤 Вы отписались от канала.\n\nЕсли это произошло случайно, вы можете подписаться снова."
+                    )
+                ]
+
+                db.add_all(sample_messages)
+                await db.commit()
+                logger.info("✅ Добавлены стандартные сообщения в БД")
+            else:
+                logger.info("✅ Сообщения уже существуют в БД")
 
     except Exception as e:
         logger.error(f"❌ Ошибка добавления сообщений: {e}")
-        db.rollback()
-    finally:
-        db.close()
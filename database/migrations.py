@@ -0,0 +1,48 @@
+import logging
+
+from sqlalchemy import inspect, text
+
+logger = logging.getLogger(__name__)
+
+
+def _add_column(conn, table: str, column: str, ddl: str):
+    columns = {c["name"] for c in inspect(conn).get_columns(table)}
+    if column not in columns:
+        conn.execute(text(f"ALTER TABLE {table} ADD COLUMN {column} {ddl}"))
+        logger.info(f"🛠 Добавлена колонка {table}.{column}")
+
+
+def _add_index(conn, table: str, name: str, ddl: str):
+    indexes = {ix["name"] for ix in inspect(conn).get_indexes(table)}
+    if name not in indexes:
+        conn.execute(text(ddl))
+        logger.info(f"🛠 Создан индекс {name}")
+
+
+def migrate(conn):
+    """
+    Идемпотентные изменения схемы для уже существующих баз
+    (create_all создаёт только новые таблицы, но не колонки и индексы).
+    Выполняется синхронно внутри conn.run_sync().
+    """
+    _add_column(conn, "users", "created_at", "TIMESTAMP")
+    _add_column(conn, "users", "probed_at", "TIMESTAMP")
+    _add_index(conn, "users", "ix_users_created_at", "CREATE INDEX ix_users_created_at ON users (created_at)")
+    _add_index(conn, "users", "ix_users_is_active", "CREATE INDEX ix_users_is_active ON users (is_active)")
+    _add_column(conn, "broadcast_jobs", "rate", "FLOAT")
+    _add_column(conn, "broadcast_jobs", "scheduled_at", "TIMESTAMP")
+    _add_column(conn, "broadcast_jobs", "spread_minutes", "INTEGER")
+
+    # Перед уникальным индексом убираем дубликаты заявок, оставляя самую раннюю
+    indexes = {ix["name"] for ix in inspect(conn).get_indexes("pending_requests")}
+    if "ux_pending_requests_user_chat" not in indexes:
+        result = conn.execute(text(
+            "DELETE FROM pending_requests WHERE id NOT IN "
+            "(SELECT min_id FROM (SELECT MIN(id) AS min_id FROM pending_requests GROUP BY user_id, chat_id) AS keep)"
+        ))
+        if result.rowcount:
+            logger.info(f"🧹 Удалено дубликатов pending-заявок: {result.rowcount}")
+        _add_index(
+            conn, "pending_requests", "ux_pending_requests_user_chat",
+            "CREATE UNIQUE INDEX ux_pending_requests_user_chat ON pending_requests (user_id, chat_id)"
+        )
@@ -1,7 +1,5 @@
 from aiogram.types import InlineKeyboardMarkup, InlineKeyboardButton
 
-from database.database import SessionLocal, Channel
-
 
 def admin_menu_kb():
     """Главное меню администратора"""
@@ -12,6 +10,8 @@ def admin_menu_kb():
         [InlineKeyboardButton(text="📜 Список каналов", callback_data="list_channels")],
         [InlineKeyboardButton(text="📢 Рассылка", callback_data="announcement")],
         [InlineKeyboardButton(text="📢 Премиум рассылка", callback_data="prem_announcement")],
+        [InlineKeyboardButton(text="📋 Рассылки", callback_data="broadcast_jobs")],
+        [InlineKeyboardButton(text="☠️ Недоставленные", callback_data="dead_letters")],
         [InlineKeyboardButton(text="Редактировать сообщения", callback_data="edit_messages")],
         [InlineKeyboardButton(text="Статистика", callback_data="total_users")],
     ])
@@ -40,10 +40,35 @@ choose_kb = InlineKeyboardMarkup(inline_keyboard=[
     ])
 
 
-push_kb = InlineKeyboardMarkup(inline_keyboard=[
-        [InlineKeyboardButton(text="🚀 Разослать", callback_data="send_broadcast")],
+def push_kb(audience_size: int, audience: dict, scheduled_at: str | None = None, spread_minutes: int | None = None,
+            pending_channels=()):
+    """
+    Подтверждение рассылки: размер аудитории, переключатели сегментов, время и растягивание отправки.
+    pending_channels — каналы, по заявкам в которые можно выбрать аудиторию (один за раз)
+    """
+    def mark(enabled):
+        return "✅" if enabled else "▫️"
+
+    days = audience.get("registered_days")
+    pending_chat_id = audience.get("pending_chat_id")
+    kb = InlineKeyboardMarkup(inline_keyboard=[
+        [InlineKeyboardButton(text=f"{mark(audience.get('reprobe'))} Перепроверить неактивных",
+                              callback_data="aud_reprobe")],
+        [InlineKeyboardButton(text=f"{mark(days == 7)} Новые за 7 дней", callback_data="aud_days_7"),
+         InlineKeyboardButton(text=f"{mark(days == 30)} Новые за 30 дней", callback_data="aud_days_30")],
+        *[
+            [InlineKeyboardButton(text=f"{mark(pending_chat_id == ch.channel_id)} С заявкой в «{ch.name}»",
+                                  callback_data=f"aud_pending_{ch.channel_id}")]
+            for ch in pending_channels
+        ],
+        [InlineKeyboardButton(text=f"🕒 Отправить {scheduled_at}" if scheduled_at else "🕒 Отправить сейчас",
+                              callback_data="sched_time")],
+        [InlineKeyboardButton(text=f"⏱ Растянуть на {spread_minutes} мин" if spread_minutes else "⏱ Без растягивания",
+                              callback_data="sched_spread")],
+        [InlineKeyboardButton(text=f"🚀 Разослать ({audience_size})", callback_data="send_broadcast")],
         [InlineKeyboardButton(text="🏠 Главное меню", callback_data="admin_menu")]
     ])
+    return kb
 
 
 
@@ -52,11 +77,27 @@ check_btn = InlineKeyboardMarkup(inline_keyboard=[
     ])
 
 
-def delete_channels_kb():
-    db = SessionLocal()
-    channels = db.query(Channel).all()
-    db.close()
+def start_channels_kb(channels):
+    """Кнопки каналов для /start"""
+    buttons = [
+        [InlineKeyboardButton(text=f"📢 Канал {i+1}", url=ch.link)]
+        for i, ch in enumerate(channels)
+    ]
+    buttons.append([InlineKeyboardButton(text="✅ Я подписался", callback_data="check_subscription")])
+    return InlineKeyboardMarkup(inline_keyboard=buttons)
+
+
+def missing_channels_kb(channels):
+    """Кнопки каналов, на которые пользователь ещё не подписан"""
+    buttons = [
+        [InlineKeyboardButton(text=f"📢 Канал {i+1}", url=ch.link)]
+        for i, ch in enumerate(channels)
+    ]
+    buttons.append([InlineKeyboardButton(text="✅ Проверить подписку", callback_data="check_subscription")])
+    return InlineKeyboardMarkup(inline_keyboard=buttons)
+
 
+def delete_channels_kb(channels):
     if not channels:
         return None
 
@@ -75,4 +116,25 @@ def delete_channels_kb():
     )])
 
     kb = InlineKeyboardMarkup(inline_keyboard=buttons)
-    return kb
\ No newline at end of file
+    return kb
+
+
+def scheduled_job_kb(job_id: int):
+    """Отмена отложенной рассылки"""
+    kb = InlineKeyboardMarkup(inline_keyboard=[
+        [InlineKeyboardButton(text="⏹ Отменить", callback_data=f"bc_cancel_{job_id}")],
+        [InlineKeyboardButton(text="🏠 Главное меню", callback_data="admin_menu")]
+    ])
+    return kb
+
+
+def broadcast_control_kb(job_id: int, paused: bool):
+    """Управление идущей рассылкой под сообщением с прогрессом"""
+    toggle = (InlineKeyboardButton(text="▶️ Продолжить", callback_data=f"bc_resume_{job_id}") if paused
+              else InlineKeyboardButton(text="⏸ Пауза", callback_data=f"bc_pause_{job_id}"))
+    kb = InlineKeyboardMarkup(inline_keyboard=[
+        [toggle, InlineKeyboardButton(text="⏹ Отменить", callback_data=f"bc_cancel_{job_id}")],
+        [InlineKeyboardButton(text="🐢 Медленнее", callback_data=f"bc_slower_{job_id}"),
+         InlineKeyboardButton(text="🚀 Быстрее", callback_data=f"bc_faster_{job_id}")],
+    ])
+    return kb
@@ -0,0 +1,77 @@
+import asyncio
+
+from aiogram import Bot, Dispatcher
+
+from config import BOT_TOKEN, TEMPLATES_RELOAD_INTERVAL
+from database.database import init_db, add_sample_messages, engine
+from routers.admin_router import admin_router
+from routers.bot_router import bot_router
+from services.broadcast_manager import broadcast_manager
+from services.channels import channel_registry
+from services.dispatch import update_lanes
+from services.flood_control import flood_governor
+from services.fsm_storage import fsm_storage
+from services.http_session import TunedAiohttpSession
+from services.retry_queue import retry_queue
+from services.scheduler import scheduler
+from services.templates import templates
+from services.write_buffer import write_buffer
+
+
+def create_bot() -> Bot:
+    """Бот с настроенным пулом соединений; все запросы идут через общий для процесса лимитер Bot API"""
+    bot = Bot(token=BOT_TOKEN, session=TunedAiohttpSession())
+    bot.session.middleware(flood_governor)
+    return bot
+
+
+bot = create_bot()
+dp = Dispatcher(storage=fsm_storage)
+dp.include_router(bot_router)
+dp.include_router(admin_router)
+dp.update.outer_middleware(update_lanes)
+
+background_tasks = []
+
+
+async def init_database():
+    await init_db()
+    await add_sample_messages()
+
+
+async def start_services(bot: Bot, resume_broadcasts: bool = True):
+    """Кэши и фоновые задачи одного процесса, обрабатывающего апдейты"""
+    await templates.load()
+    await channel_registry.load()
+
+    write_buffer.start()
+    fsm_storage.start()
+    retry_queue.start()
+    if TEMPLATES_RELOAD_INTERVAL > 0:
+        background_tasks.append(asyncio.create_task(templates.run_reloader(TEMPLATES_RELOAD_INTERVAL)))
+    # Рассылки (незавершённые и по расписанию) ведёт только один процесс
+    if resume_broadcasts:
+        await broadcast_manager.resume_jobs(bot)
+        background_tasks.append(asyncio.create_task(scheduler.run(bot)))
+
+
+async def stop_services():
+    await update_lanes.drain()
+    await broadcast_manager.stop()
+    for task in background_tasks:
+        task.cancel()
+    await retry_queue.stop()
+    await write_buffer.stop()
+    await fsm_storage.close()
+    await engine.dispose()
+
+
+@dp.startup()
+async def on_startup(bot: Bot):
+    await init_database()
+    await start_services(bot)
+
+
+@dp.shutdown()
+async def on_shutdown():
+    await stop_services()
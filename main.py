@@ -1,37 +1,65 @@
 import asyncio
 import logging
 
-from aiogram import Bot, Dispatcher
+from aiohttp import web
 
-from config import BOT_TOKEN
-from database.database import init_db, add_sample_messages
-from routers.admin_router import admin_router
-from routers.bot_router import bot_router
+from config import BOT_MODE, WORKERS, WEBHOOK_BASE_URL, WEBHOOK_PATH, WEBHOOK_SECRET, WEBAPP_HOST, WEBAPP_PORT
+from database.database import engine
+from loader import bot, dp, init_database
+from services.sharding import run_sharded_polling
+from services.webhook import create_webhook_app
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
-bot = Bot(token=BOT_TOKEN)
-dp = Dispatcher()
-dp.include_router(bot_router)
-dp.include_router(admin_router)
+
+async def run_polling():
+    await bot.delete_webhook()
+    try:
+        if WORKERS > 1:
+            # Схема и стартовые данные создаются один раз, до запуска воркеров
+            await init_database()
+            await engine.dispose()
+            await run_sharded_polling(bot, dp, WORKERS)
+        else:
+            # Апдейты раскладывает по очередям пользователей UserLanes; поллинг ждёт,
+            # пока в очередях есть место, вместо создания задачи на каждый апдейт
+            await dp.start_polling(bot, handle_as_tasks=False)
+    finally:
+        await bot.session.close()
+
+
+async def run_webhook():
+    """aiohttp-сервер на WEBAPP_HOST:WEBAPP_PORT; без WEBHOOK_BASE_URL вебхук не регистрируется (локальный режим)"""
+    if WEBHOOK_BASE_URL:
+        await bot.set_webhook(
+            WEBHOOK_BASE_URL.rstrip("/") + WEBHOOK_PATH,
+            secret_token=WEBHOOK_SECRET or None,
+            allowed_updates=dp.resolve_used_update_types(),
+        )
+    app = create_webhook_app(dp, bot)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, WEBAPP_HOST, WEBAPP_PORT).start()
+    logger.info(f"🌐 Webhook слушает {WEBAPP_HOST}:{WEBAPP_PORT}{WEBHOOK_PATH}")
+    try:
+        await asyncio.Event().wait()
+    finally:
+        await runner.cleanup()
 
 
 async def main():
     logger.info("🚀 Bot starting...")
-    init_db()
-    add_sample_messages()
     try:
-        await dp.start_polling(bot)
+        if BOT_MODE == "webhook":
+            await run_webhook()
+        else:
+            await run_polling()
     except Exception as e:
         logger.error(f"❌ Bot stopped with error: {e}")
     finally:
         logger.info("🛑 Bot stopped")
-        await bot.session.close()
 
 
 if __name__ == '__main__':
     asyncio.run(main())
-
-
-
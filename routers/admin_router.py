@@ -1,20 +1,35 @@
-import asyncio
 import logging
+from datetime import datetime
 
 from aiogram import Router, F, types
 from aiogram.enums import ParseMode
-from aiogram.exceptions import TelegramBadRequest, TelegramForbiddenError, TelegramNotFound, TelegramAPIError
 from aiogram.fsm.context import FSMContext
 from aiogram.fsm.state import StatesGroup, State
 from aiogram.types import InlineKeyboardMarkup, InlineKeyboardButton
-
-from config import ADMIN_ID
-from database.database import SessionLocal, Channel, User, TargetChannel
-from keyboard import admin_menu_kb, delete_channels_kb, main_menu_btn, push_kb, target_menu
+from sqlalchemy import select, delete, func
+
+from config import ADMIN_ID, SCHEDULE_UTC_OFFSET
+from database.database import async_session, Channel, User, TargetChannel
+from keyboard import admin_menu_kb, main_menu_btn, push_kb, target_menu, broadcast_control_kb, scheduled_job_kb
+from services import invalidation
+from services.audience import count_audience
+from services.broadcast_jobs import create_job, list_jobs, job_progress
+from services.broadcast_manager import broadcast_manager
+from services.channels import channel_registry
+from services.dispatch import update_lanes
+from services.flood_control import flood_governor
+from services.http_session import TunedAiohttpSession
+from services.personalize import compile_template
+from services.render import entities_to_html, entity_dicts
+from services.retry_queue import retry_queue
+from services.scheduler import scheduler, parse_local_time, format_local_time
+from services.templates import templates
 
 logger = logging.getLogger(__name__)
 admin_router = Router()
 
+PLACEHOLDERS_HINT = "\n\nℹ️ Подстановки: {first_name} — имя получателя, {username} — его username"
+
 # --- FSM ---
 class ChannelStates(StatesGroup):
     waiting_for_channel_id = State()
@@ -25,6 +40,8 @@ class BroadcastStates(StatesGroup):
     waiting_for_media = State()
     waiting_for_text = State()
     preview_ready = State()
+    waiting_for_schedule = State()
+    waiting_for_spread = State()
 
     waiting_broadcast_message=State()
 
@@ -61,7 +78,6 @@ async def add_channel_start(callback: types.CallbackQuery, state: FSMContext):
 
 @admin_router.message(ChannelStates.waiting_for_channel_id)
 async def add_channel_by_id(message: types.Message, state: FSMContext):
-    db = SessionLocal()
     try:
         try:
             chat_id = int(message.text.strip())
@@ -182,21 +198,25 @@ async def add_channel_by_id(message: types.Message, state: FSMContext):
             return
 
         # Проверка на дубликат
-        existing = db.query(Channel).filter_by(channel_id=chat_id).first()
+        async with async_session() as db:
+            existing = await db.scalar(select(Channel).filter_by(channel_id=chat_id))
+            if not existing:
+                new_ch = Channel(
+                    channel_id=chat_id,
+                    name=channel_name,
+                    link=link
+                )
+                db.add(new_ch)
+                await db.commit()
+                await channel_registry.reload()
+                invalidation.publish("channels")
+
         if existing:
             await message.answer(
                 "⚠️ Этот канал/чат уже есть в базе",
                 reply_markup=main_menu_btn
             )
         else:
-            new_ch = Channel(
-                channel_id=chat_id,
-                name=channel_name,
-                link=link
-            )
-            db.add(new_ch)
-            db.commit()
-
             link_type = "Прямая подписка" if chat_obj.username else "Заявка на вступление"
 
             await message.answer(
@@ -215,8 +235,6 @@ async def add_channel_by_id(message: types.Message, state: FSMContext):
         logger.error(f"Ошибка добавления канала: {e}")
         await message.answer("❌ Ошибка при добавлении.")
         await state.clear()
-    finally:
-        db.close()
 
 
 @admin_router.callback_query(F.data == "delete_channel")
@@ -224,7 +242,7 @@ async def show_delete_channels(callback: types.CallbackQuery):
     if not is_admin(callback.from_user.id):
         await callback.answer("Нет доступа", show_alert=True)
         return
-    kb = delete_channels_kb()
+    kb = channel_registry.delete_kb
     if not kb:
         await callback.message.edit_text("📭 Нет каналов для удаления.", reply_markup=main_menu_btn)
         await callback.answer()
@@ -241,23 +259,23 @@ async def delete_selected_channel(callback: types.CallbackQuery):
         await callback.answer("❌ Нет доступа", show_alert=True)
         return
     ch_id = int(callback.data.split("_")[1])
-    db = SessionLocal()
     try:
-        ch = db.query(Channel).filter_by(channel_id=ch_id).first()
-        if not ch:
-            text = f"❌ Канал с id {ch_id} не найден."
-        else:
-            link = ch.link
-            db.delete(ch)
-            db.commit()
-            text = f"🗑 Канал удалён: {link} (id: {ch_id})"
+        async with async_session() as db:
+            ch = await db.scalar(select(Channel).filter_by(channel_id=ch_id))
+            if not ch:
+                text = f"❌ Канал с id {ch_id} не найден."
+            else:
+                link = ch.link
+                await db.delete(ch)
+                await db.commit()
+                await channel_registry.reload()
+                invalidation.publish("channels")
+                text = f"🗑 Канал удалён: {link} (id: {ch_id})"
         await callback.message.edit_text(text, reply_markup=main_menu_btn)
         await callback.answer()
     except Exception as e:
         logger.error(f"Ошибка удаления канала: {e}")
         await callback.answer("⚠️ Ошибка удаления.", show_alert=True)
-    finally:
-        db.close()
 
 
 
@@ -280,17 +298,7 @@ async def list_channels(callback: types.CallbackQuery):
         await callback.answer("Нет доступа", show_alert=True)
         return
 
-    db = SessionLocal()
-    channels = db.query(Channel).all()
-    db.close()
-
-    if not channels:
-        text = "📭 Список каналов пуст."
-    else:
-        text = "📜 Список каналов:\n\n"
-        for ch in channels:
-            text += f"➡️ <a href='{ch.link}'>{ch.name}</a>\n"
-    await callback.message.edit_text(text, reply_markup=main_menu_btn, parse_mode=ParseMode.HTML)
+    await callback.message.edit_text(channel_registry.list_text, reply_markup=main_menu_btn, parse_mode=ParseMode.HTML)
     await callback.answer()
 
 
@@ -309,43 +317,13 @@ async def announcement_start(callback: types.CallbackQuery, state: FSMContext):
 
 @admin_router.message(BroadcastStates.waiting_broadcast_message)
 async def process_forward_message(message: types.Message, state: FSMContext):
-    db = SessionLocal()
-    users = db.query(User).all()
-    db.close()
-    await message.answer("🚀 Начинаю рассылку...")
-    success, failed = 0, 0
-    for user in users:
-        try:
-            await message.bot.forward_message(
-                chat_id=user.user_id,
-                from_chat_id=message.chat.id,
-                message_id=message.message_id
-            )
-            success += 1
-        except (TelegramForbiddenError, TelegramNotFound):
-            # Помечаем пользователя как неактивного
-            db2 = SessionLocal()
-            try:
-                db2.query(User).filter(User.user_id == user.user_id).update({"is_active": False})
-                db2.commit()
-            except Exception:
-                db2.rollback()
-            finally:
-                db2.close()
-            failed += 1
-        except Exception as e:
-            logger.warning(f"Не удалось отправить {user.user_id}: {e}")
-            failed += 1
-        await asyncio.sleep(0.1)
-    total = success + failed
-    await message.answer(
-        f"✅ Рассылка завершена!\n\n"
-        f"📨 Успешно: <b>{success * 5}</b>\n"
-        f"⚠️ Ошибок: <b>{failed * 5}</b>\n"
-        f"👥 Всего пользователей: <b>{total * 5}</b>",
-        parse_mode="HTML",
-        reply_markup=main_menu_btn
+    job_id = await create_job(
+        "forward",
+        {"from_chat_id": message.chat.id, "message_id": message.message_id},
+        admin_chat_id=message.chat.id
     )
+    # Рассылка идёт в фоне, прогресс и кнопки управления — в отдельном сообщении
+    await broadcast_manager.start(message.bot, job_id, message.chat.id)
     await state.clear()
 
 
@@ -389,7 +367,7 @@ async def broadcast_media_choice(callback: types.CallbackQuery, state: FSMContex
         await callback.message.edit_text("🎥 Отправьте видео для рассылки:")
         await state.set_state(BroadcastStates.waiting_for_media)
     else:  # broadcast_text_only
-        await callback.message.edit_text("📝 Введите текст рассылки:")
+        await callback.message.edit_text("📝 Введите текст рассылки:" + PLACEHOLDERS_HINT)
         await state.set_state(BroadcastStates.waiting_for_text)
 
     await callback.answer()
@@ -403,7 +381,7 @@ async def receive_broadcast_photo(message: types.Message, state: FSMContext):
     if media_type == "broadcast_photo":
         photo = message.photo[-1].file_id
         await state.update_data(broadcast_media=photo, media_type="photo")
-        await message.answer("📝 Теперь введите текст рассылки:")
+        await message.answer("📝 Теперь введите текст рассылки:" + PLACEHOLDERS_HINT)
         await state.set_state(BroadcastStates.waiting_for_text)
     else:
         await message.answer("❌ Ожидалось фото. Попробуйте снова.")
@@ -417,125 +395,148 @@ async def receive_broadcast_video(message: types.Message, state: FSMContext):
     if media_type == "broadcast_video":
         video = message.video.file_id
         await state.update_data(broadcast_media=video, media_type="video")
-        await message.answer("📝 Теперь введите текст рассылки:")
+        await message.answer("📝 Теперь введите текст рассылки:" + PLACEHOLDERS_HINT)
         await state.set_state(BroadcastStates.waiting_for_text)
     else:
         await message.answer("❌ Ожидалось видео. Попробуйте снова.")
 
 
-import re
-
 @admin_router.message(BroadcastStates.waiting_for_text)
 async def receive_broadcast_text(message: types.Message, state: FSMContext):
     """
-    Сохраняем текст рассылки с кликабельными ссылками, корректно для кириллицы.
+    Сохраняем текст рассылки в HTML со всей разметкой сообщения (ссылки, жирный, спойлеры и т.д.).
     """
-    text = message.text or ""
-    html_text = ""
-
-    if message.entities:
-        prev_end = 0
-        for ent in message.entities:
-            start = ent.offset
-            end = ent.offset + ent.length
-
-            # Проверяем, начинается ли entity с кириллической буквы
-            if start > 0 and re.match(r"[А-Яа-яЁё]", text[start - 1:start + 1]):
-                start -= 1  # Telegram даёт оффсет на 1 больше, чем нужно
-
-            # Добавляем текст до entity
-            html_text += text[prev_end:start]
-
-            entity_text = ent.extract_from(text)
-            if ent.type in ("url", "text_link"):
-                url = ent.url if ent.type == "text_link" else entity_text
-                html_text += f'<a href="{url}">{entity_text}</a>'
-            else:
-                html_text += entity_text
-
-            prev_end = end
-
-        # Добавляем остаток текста
-        html_text += text[prev_end:]
-    else:
-        html_text = text
+    html_text = entities_to_html(message.text or "", entity_dicts(message.entities))
 
     logger.info(f"Сохраняемый HTML текст: {repr(html_text)}")
 
-    await state.update_data(broadcast_text=html_text)
+    await state.update_data(broadcast_text=html_text, audience={}, scheduled_at=None, spread_minutes=None)
 
+    # В предпросмотре подстановки заполняются данными самого админа
     await message.answer(
-        f"📢 Предпросмотр рассылки:\n\n{html_text}",
+        f"📢 Предпросмотр рассылки:\n\n{compile_template(html_text).render_for(message.from_user)}",
         parse_mode=ParseMode.HTML,
-        reply_markup=push_kb
+        reply_markup=push_kb(await count_audience({}), {}, pending_channels=channel_registry.pending_channels)
     )
     await state.set_state(BroadcastStates.preview_ready)
 
 
-async def send_broadcast(bot, text: str, media_type: str = None, media_file_id: str = None):
-    db = SessionLocal()
-    users = db.query(User).all()
-    db.close()
+@admin_router.callback_query(BroadcastStates.preview_ready, F.data.startswith("aud_"))
+async def toggle_broadcast_audience(callback: types.CallbackQuery, state: FSMContext):
+    """Переключение сегмента аудитории на экране подтверждения"""
+    if not is_admin(callback.from_user.id):
+        await callback.answer("Нет доступа", show_alert=True)
+        return
+
+    data = await state.get_data()
+    audience = dict(data.get("audience") or {})
+
+    if callback.data == "aud_reprobe":
+        audience["reprobe"] = not audience.get("reprobe")
+    elif callback.data.startswith("aud_days_"):
+        days = int(callback.data.rsplit("_", 1)[1])
+        audience["registered_days"] = None if audience.get("registered_days") == days else days
+    elif callback.data.startswith("aud_pending_"):
+        chat_id = int(callback.data.rsplit("_", 1)[1])
+        audience["pending_chat_id"] = None if audience.get("pending_chat_id") == chat_id else chat_id
+
+    await state.update_data(audience=audience)
+    await callback.message.edit_reply_markup(reply_markup=await preview_kb(await state.get_data()))
+    await callback.answer()
 
-    success = 0
-    fails = 0
 
-    for user in users:
-        try:
-            if media_type == "photo" and media_file_id:
-                await bot.send_photo(user.user_id, photo=media_file_id, caption=text, parse_mode=ParseMode.HTML)
-            elif media_type == "video" and media_file_id:
-                await bot.send_video(user.user_id, video=media_file_id, caption=text, parse_mode=ParseMode.HTML)
-            else:
-                await bot.send_message(user.user_id, text=text, parse_mode=ParseMode.HTML)
+async def preview_kb(data: dict):
+    """Клавиатура подтверждения рассылки по данным FSM: аудитория, время и растягивание"""
+    audience = data.get("audience") or {}
+    scheduled_at = data.get("scheduled_at")
+    return push_kb(
+        await count_audience(audience), audience,
+        scheduled_at=format_local_time(datetime.fromisoformat(scheduled_at)) if scheduled_at else None,
+        spread_minutes=data.get("spread_minutes"),
+        pending_channels=channel_registry.pending_channels,
+    )
 
-            success += 1
 
-            # Восстановление, если раньше был неактивен
-            if not user.is_active:
-                db2 = SessionLocal()
-                try:
-                    db2.query(User).filter(User.user_id == user.user_id).update({"is_active": True})
-                    db2.commit()
-                except Exception as ex2:
-                    db2.rollback()
-                    logger.error(f"Ошибка при восстановлении is_active для {user.user_id}: {ex2}")
-                finally:
-                    db2.close()
-
-        except (TelegramForbiddenError, TelegramNotFound) as e:
-            # бот заблокирован / чат не найден / пользователь неактивен — помечаем неактивным
-            logger.warning(f"Не удалось доставить сообщение пользователю {user.user_id}: {e}")
-            db2 = SessionLocal()
-            try:
-                db2.query(User).filter(User.user_id == user.user_id).update({"is_active": False})
-                db2.commit()
-            except Exception as ex2:
-                db2.rollback()
-                logger.error(f"Ошибка при установке is_active=False для {user.user_id}: {ex2}")
-            finally:
-                db2.close()
-            fails += 1
-
-        except TelegramBadRequest as e:
-            # возможные ошибки формата, недопустимые запросы
-            logger.warning(f"BadRequest при отправке пользователю {user.user_id}: {e}")
-            fails += 1
-
-        except TelegramAPIError as e:
-            # общий класс ошибок API
-            logger.error(f"TelegramAPIError при отправке пользователю {user.user_id}: {e}")
-            fails += 1
+@admin_router.callback_query(BroadcastStates.preview_ready, F.data.in_(["sched_time", "sched_spread"]))
+async def ask_broadcast_schedule(callback: types.CallbackQuery, state: FSMContext):
+    """Запрос времени отправки или длительности растягивания рассылки"""
+    if not is_admin(callback.from_user.id):
+        await callback.answer("Нет доступа", show_alert=True)
+        return
 
-        except Exception as e:
-            # все прочие неожиданные ошибки
-            logger.exception(f"Неожиданная ошибка при отправке {user.user_id}: {e}")
-            fails += 1
+    if callback.data == "sched_time":
+        await callback.message.answer(
+            f"🕒 Когда отправить рассылку? Введите время «ЧЧ:ММ» или «ДД.ММ ЧЧ:ММ» (UTC{SCHEDULE_UTC_OFFSET:+g}).\n"
+            f"Чтобы отправить сразу — «0»."
+        )
+        await state.set_state(BroadcastStates.waiting_for_schedule)
+    else:
+        await callback.message.answer(
+            "⏱ За сколько минут разослать? Отправка пойдёт равномерно, а не пачкой.\n"
+            "Введите число минут, «0» — без растягивания."
+        )
+        await state.set_state(BroadcastStates.waiting_for_spread)
+    await callback.answer()
 
-        await asyncio.sleep(0.1)
 
-    logger.info(f"Рассылка завершена: успешно={success}, неудач={fails}")
-    return fails
+@admin_router.message(BroadcastStates.waiting_for_schedule)
+async def receive_broadcast_schedule(message: types.Message, state: FSMContext):
+    text = (message.text or "").strip()
+    scheduled_at = None
+    if text != "0":
+        scheduled_at = parse_local_time(text)
+        if not scheduled_at:
+            await message.answer("❌ Не удалось распознать время. Пример: 18:30 или 25.12 18:30")
+            return
+
+    await state.update_data(scheduled_at=scheduled_at.isoformat() if scheduled_at else None)
+    await message.answer(
+        f"🕒 Рассылка будет отправлена {format_local_time(scheduled_at)}" if scheduled_at
+        else "🕒 Рассылка будет отправлена сразу",
+        reply_markup=await preview_kb(await state.get_data())
+    )
+    await state.set_state(BroadcastStates.preview_ready)
+
+
+@admin_router.message(BroadcastStates.waiting_for_spread)
+async def receive_broadcast_spread(message: types.Message, state: FSMContext):
+    text = (message.text or "").strip()
+    if not text.isdigit() or int(text) > 7 * 24 * 60:
+        await message.answer("❌ Введите число минут (не больше недели), «0» — без растягивания")
+        return
+
+    spread_minutes = int(text) or None
+    await state.update_data(spread_minutes=spread_minutes)
+    await message.answer(
+        f"⏱ Рассылка растянется на {spread_minutes} мин" if spread_minutes else "⏱ Рассылка пойдёт без растягивания",
+        reply_markup=await preview_kb(await state.get_data())
+    )
+    await state.set_state(BroadcastStates.preview_ready)
+
+
+async def send_broadcast(bot, text: str, media_type: str = None, media_file_id: str = None,
+                         admin_chat_id: int = None, audience: dict = None,
+                         scheduled_at: datetime = None, spread_minutes: int = None) -> int:
+    """Создаёт рассылку и запускает её в фоне (или оставляет планировщику), возвращает id задачи"""
+    job_id = await create_job(
+        "send",
+        {"text": text, "media_type": media_type, "media_file_id": media_file_id, "audience": audience or {}},
+        admin_chat_id=admin_chat_id, scheduled_at=scheduled_at, spread_minutes=spread_minutes
+    )
+    if scheduled_at:
+        # Планировщик пересчитает ожидание сразу, а не на следующем опросе (иначе запуск опоздает до SCHEDULER_INTERVAL).
+        # При WORKERS > 1 он работает в воркере 0, поэтому будим его и событием инвалидации
+        scheduler.wake()
+        invalidation.publish("scheduler")
+        await bot.send_message(
+            admin_chat_id,
+            f"🕒 Рассылка #{job_id} запланирована на {format_local_time(scheduled_at)}"
+            + (f", отправка растянется на {spread_minutes} мин" if spread_minutes else ""),
+            reply_markup=scheduled_job_kb(job_id)
+        )
+    else:
+        await broadcast_manager.start(bot, job_id, admin_chat_id)
+    return job_id
 
 
 @admin_router.callback_query(F.data == "send_broadcast")
@@ -545,37 +546,96 @@ async def confirm_broadcast(callback: types.CallbackQuery, state: FSMContext):
         return
     data = await state.get_data()
     text = data.get("broadcast_text")
+    if text is None:
+        # Повторное нажатие: состояние уже очищено первым запуском
+        await callback.answer("Рассылка уже запущена", show_alert=True)
+        return
     media_type = data.get("media_type")
     media_file_id = data.get("broadcast_media")
+    audience = data.get("audience") or {}
+    scheduled_at = datetime.fromisoformat(data["scheduled_at"]) if data.get("scheduled_at") else None
 
-    # Отправляем рассылку
-    a = await send_broadcast(callback.bot, text=text, media_type=media_type, media_file_id=media_file_id)
+    # Запускаем рассылку в фоне: прогресс и кнопки управления придут отдельным сообщением
+    await send_broadcast(callback.bot, text=text, media_type=media_type, media_file_id=media_file_id,
+                         admin_chat_id=callback.from_user.id, audience=audience,
+                         scheduled_at=scheduled_at, spread_minutes=data.get("spread_minutes"))
+    await state.clear()
+    await callback.answer("🕒 Рассылка запланирована" if scheduled_at else "🚀 Рассылка запущена")
 
-    # Статистика рассылки
-    db = SessionLocal()
-    total_users = db.query(User).count()
-    db.close()
 
-    stats_text = (
-        f"✅ Рассылка завершена!\n"
-        f"📊 Всего пользователей: {total_users*5}\n"
-        f"Неудач : {a*5}\n"
-        f"💬 Тип: {'Фото' if media_type == 'photo' else 'Видео' if media_type == 'video' else 'Текст'}"
-    )
+@admin_router.callback_query(F.data.regexp(r"^bc_(pause|resume|cancel|slower|faster)_\d+$"))
+async def control_broadcast(callback: types.CallbackQuery):
+    """Кнопки под сообщением с прогрессом рассылки"""
+    if not is_admin(callback.from_user.id):
+        await callback.answer("Нет доступа", show_alert=True)
+        return
 
-    await callback.message.answer(stats_text, reply_markup=main_menu_btn)
-    await state.clear()
+    _, action, job_id = callback.data.split("_")
+    status = await broadcast_manager.control(int(job_id), action)
+    if status is None:
+        await callback.answer("Рассылка уже завершена", show_alert=True)
+        return
+    if action in ("pause", "resume"):
+        await callback.message.edit_reply_markup(reply_markup=broadcast_control_kb(int(job_id), status == "paused"))
+    answers = {
+        "pause": "⏸ Пауза",
+        "resume": "▶️ Продолжаем",
+        "cancel": "⏹ Отменяем рассылку",
+        "slower": "🐢 Скорость снижена",
+        "faster": "🚀 Скорость увеличена",
+    }
+    await callback.answer(answers[action])
+
+@admin_router.callback_query(F.data == "broadcast_jobs")
+async def show_broadcast_jobs(callback: types.CallbackQuery):
+    """Последние рассылки и процент их выполнения"""
+    if not is_admin(callback.from_user.id):
+        await callback.answer("Нет доступа", show_alert=True)
+        return
+
+    jobs = await list_jobs()
+    if not jobs:
+        text = "📭 Рассылок ещё не было."
+    else:
+        statuses = {"scheduled": "🕒 запланирована", "running": "⏳ идёт", "paused": "⏸ пауза", "cancelled": "⏹ отменена",
+                    "done": "✅ завершена", "failed": "❌ ошибка"}
+        text = "📋 Последние рассылки:\n\n" + "\n".join(
+            f"#{job.id} · {job.created_at:%d.%m %H:%M} · {statuses.get(job.status, job.status)} · {job_progress(job)}%"
+            for job in jobs
+        )
+    await callback.message.edit_text(text, reply_markup=main_menu_btn)
     await callback.answer()
 
+
+@admin_router.callback_query(F.data == "dead_letters")
+async def show_dead_letters(callback: types.CallbackQuery):
+    """Отправки, не прошедшие после всех повторов (блокировки бота сюда не попадают)"""
+    if not is_admin(callback.from_user.id):
+        await callback.answer("Нет доступа", show_alert=True)
+        return
+
+    letters = list(retry_queue.dead_letters)[-20:]
+    text = f"🔁 В очереди повторов: {len(retry_queue)}\n\n"
+    if not letters:
+        text += "☠️ Недоставленных нет."
+    else:
+        text += f"☠️ Недоставленные (последние {len(letters)} из {len(retry_queue.dead_letters)}):\n\n" + "\n".join(
+            f"{letter.at:%d.%m %H:%M} · {letter.name} · {letter.attempts} попыток · {letter.error}"
+            for letter in reversed(letters)
+        )
+    await callback.message.edit_text(text[:4096], reply_markup=main_menu_btn)
+    await callback.answer()
+
+
 @admin_router.callback_query(F.data == "edit_messages")
 async def handle_edit_messages(callback: types.CallbackQuery):
     """Показываем клавиатуру для выбора сообщения из БД"""
 
-    db = SessionLocal()
     try:
         # Получаем сообщения из БД
         from database.database import Message
-        messages = db.query(Message).all()
+        async with async_session() as db:
+            messages = (await db.scalars(select(Message))).all()
 
         if not messages:
             await callback.answer("❌ Нет сообщений для редактирования", show_alert=True)
@@ -604,8 +664,6 @@ async def handle_edit_messages(callback: types.CallbackQuery):
     except Exception as e:
         logger.error(f"Ошибка при загрузке сообщений: {e}")
         await callback.answer("❌ Ошибка загрузки сообщений", show_alert=True)
-    finally:
-        db.close()
 
     await callback.answer()
 
@@ -620,10 +678,9 @@ async def start_edit_message(callback: types.CallbackQuery, state: FSMContext):
     try:
         message_id = int(callback.data.split("_")[2])
 
-        db = SessionLocal()
         from database.database import Message
-        message = db.query(Message).filter(Message.id == message_id).first()
-        db.close()
+        async with async_session() as db:
+            message = await db.scalar(select(Message).where(Message.id == message_id))
 
         if not message:
             await callback.answer("❌ Сообщение не найдено", show_alert=True)
@@ -635,8 +692,8 @@ async def start_edit_message(callback: types.CallbackQuery, state: FSMContext):
         # Показываем текущий текст и запрашиваем новый
         await callback.message.edit_text(
             f"✏️ Редактирование: <b>{message.title}</b>\n\n"
-            f"<b>Текущий текст:</b>\n{message.text}\n\n"
-            f"📝 Отправьте новый текст сообщения:",
+            f"<b>Текущий текст:</b>\n{entities_to_html(message.text, message.entities)}\n\n"
+            f"📝 Отправьте новый текст сообщения:" + PLACEHOLDERS_HINT,
             parse_mode="HTML", reply_markup=main_menu_btn
         )
 
@@ -658,36 +715,29 @@ async def save_edited_message(message: types.Message, state: FSMContext):
         return
 
     new_text = message.text.strip()
-    entities_data = None
-
-    # --- Сохраняем entities, если они есть ---
-    if message.entities:
-        entities_data = [
-            {
-                "type": e.type,
-                "offset": e.offset,
-                "length": e.length,
-                "url": getattr(e, "url", None)
-            }
-            for e in message.entities
-        ]
+
+    # --- Сохраняем entities со всеми полями (ссылки, язык pre, id премиум-эмодзи...) ---
+    entities_data = entity_dicts(message.entities)
 
     try:
         data = await state.get_data()
         message_id = data.get('editing_message_id')
 
-        db = SessionLocal()
         from database.database import Message
-        db_message = db.query(Message).filter(Message.id == message_id).first()
+        async with async_session() as db:
+            db_message = await db.scalar(select(Message).where(Message.id == message_id))
 
-        if db_message:
-            db_message.text = new_text
-            db_message.entities = entities_data  # 👈 сохраняем ссылки
-            db.commit()
+            if db_message:
+                db_message.text = new_text
+                db_message.entities = entities_data  # 👈 сохраняем ссылки
+                await db.commit()
+                templates.update(db_message.title, new_text, entities_data)
+                invalidation.publish("templates")
 
+        if db_message:
             await message.answer(
                 f"✅ Сообщение <b>{db_message.title}</b> обновлено!\n\n"
-                f"<b>Текст:</b>\n{new_text}",
+                f"<b>Текст:</b>\n{templates.get(db_message.title)}",
                 parse_mode="HTML",
                 reply_markup=main_menu_btn
             )
@@ -698,18 +748,8 @@ async def save_edited_message(message: types.Message, state: FSMContext):
         logger.error(f"Ошибка при сохранении сообщения: {e}")
         await message.answer("❌ Ошибка при сохранении", reply_markup=main_menu_btn)
     finally:
-        db.close()
         await state.clear()
 
-def get_target_channel():
-    db = SessionLocal()
-    try:
-        target_channel = db.query(TargetChannel).first()
-        return target_channel
-    finally:
-        db.close()
-
-
 @admin_router.callback_query(F.data == "target_channel")
 async def show_target_channel(callback: types.CallbackQuery):
     """Показываем информацию о целевом канале"""
@@ -717,7 +757,7 @@ async def show_target_channel(callback: types.CallbackQuery):
         await callback.answer("⛔ Нет доступа", show_alert=True)
         return
 
-    target_channel = get_target_channel()
+    target_channel = channel_registry.target
 
     if target_channel:
         text = (
@@ -748,7 +788,6 @@ async def change_target_channel_start(callback: types.CallbackQuery, state: FSMC
 
 @admin_router.message(ChannelStates.waiting_for_target_channel_id)
 async def set_target_channel_handler(message: types.Message, state: FSMContext):
-    db = SessionLocal()
     try:
         chat_id = int(message.text.strip())
     except ValueError:
@@ -776,14 +815,17 @@ async def set_target_channel_handler(message: types.Message, state: FSMContext):
         else:
             link = await message.bot.export_chat_invite_link(chat_id)
 
-        db.query(TargetChannel).delete()
-        new_target = TargetChannel(
-            channel_id=chat_id,
-            name=channel_name,
-            link=link
-        )
-        db.add(new_target)
-        db.commit()
+        async with async_session() as db:
+            await db.execute(delete(TargetChannel))
+            new_target = TargetChannel(
+                channel_id=chat_id,
+                name=channel_name,
+                link=link
+            )
+            db.add(new_target)
+            await db.commit()
+        await channel_registry.reload()
+        invalidation.publish("channels")
 
         await message.answer(
             f"✅ **Целевой канал успешно установлен!**\n\n"
@@ -803,22 +845,27 @@ async def set_target_channel_handler(message: types.Message, state: FSMContext):
             reply_markup=main_menu_btn
         )
         await state.clear()
-    finally:
-        db.close()
 
 @admin_router.callback_query(F.data == "total_users")
 async def show_target_channel(callback: types.CallbackQuery):
-    db = SessionLocal()
-    try:
-        total_users = db.query(User).count()
-        block_users=db.query(User).filter_by(is_active=False).count()
-    finally:
-        db.close()
+    async with async_session() as db:
+        total_users = await db.scalar(select(func.count()).select_from(User))
+        block_users = await db.scalar(select(func.count()).select_from(User).filter_by(is_active=False))
+    lanes = update_lanes.stats()
+    pool_text = ""
+    if isinstance(callback.bot.session, TunedAiohttpSession):
+        pool = callback.bot.session.stats()
+        pool_text = (f"\n🔌 Соединения Bot API: <b>{pool['in_flight']}/{pool['pool_size']}</b> "
+                     f"(пик {pool['peak_in_flight']}, сетевых ошибок {pool['network_errors']})")
     await callback.message.edit_text(
         f"📊 <b>Статистика пользователей</b>\n\n"
         f"👥 Всего пользователей: <b>{total_users * 5}</b>\n"
         f"✅ Живые: <b>{total_users * 5 - block_users * 5}</b>\n"
-        f"❌ Мертвые: <b>{block_users * 5}</b>",
+        f"❌ Мертвые: <b>{block_users * 5}</b>\n\n"
+        f"⏱ Очередь апдейтов: <b>{lanes['queued']}</b> (в работе {lanes['running']}), "
+        f"ожидание p50/max: <b>{lanes['wait_p50'] * 1000:.0f}/{lanes['wait_max'] * 1000:.0f} мс</b>\n"
+        f"🚦 Ответов 429 от Telegram: <b>{flood_governor.flood_waits}</b>"
+        + pool_text,
         parse_mode=ParseMode.HTML,
         reply_markup=main_menu_btn
     )
@@ -831,19 +878,16 @@ async def clear_pending_requests(message: types.Message):
         await message.answer("⛔ Доступ запрещён.")
         return
     """Удаляет все записи из таблицы PendingRequest"""
-    from database.database import SessionLocal, PendingRequest
-    db = SessionLocal()
+    from database.database import PendingRequest
     try:
-        count = db.query(PendingRequest).delete()
-        db.commit()
+        async with async_session() as db:
+            result = await db.execute(delete(PendingRequest))
+            await db.commit()
         await message.answer(
-            f"🧹 Удалено записей из pending-заявок: <b>{count}</b>",
+            f"🧹 Удалено записей из pending-заявок: <b>{result.rowcount}</b>",
             parse_mode="HTML"
         )
     except Exception as e:
-        db.rollback()
         await message.answer(
             f"⚠️ Ошибка при очистке pending-заявок: {e}"
-        )
-    finally:
-        db.close()
\ No newline at end of file
+        )
\ No newline at end of file
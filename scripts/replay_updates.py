@@ -0,0 +1,32 @@
+"""
+Локальная проверка webhook-режима: отправляет записанные апдейты POST-запросами.
+
+    BOT_MODE=webhook python main.py
+    python scripts/replay_updates.py updates.jsonl
+
+Файл — один JSON апдейта Telegram на строку. Адрес и секрет берутся из config.py.
+"""
+import asyncio
+import json
+import sys
+
+import aiohttp
+
+sys.path.insert(0, ".")
+from config import WEBAPP_PORT, WEBHOOK_PATH, WEBHOOK_SECRET  # noqa: E402
+
+
+async def replay(path: str):
+    url = f"http://127.0.0.1:{WEBAPP_PORT}{WEBHOOK_PATH}"
+    headers = {"X-Telegram-Bot-Api-Secret-Token": WEBHOOK_SECRET} if WEBHOOK_SECRET else {}
+    async with aiohttp.ClientSession() as session:
+        with open(path, encoding="utf-8") as f:
+            for line in f:
+                if not line.strip():
+                    continue
+                async with session.post(url, json=json.loads(line), headers=headers) as resp:
+                    print(resp.status, await resp.text())
+
+
+if __name__ == "__main__":
+    asyncio.run(replay(sys.argv[1]))
@@ -0,0 +1,64 @@
+from datetime import datetime, timedelta
+
+from sqlalchemy import select, func, or_, and_
+
+from config import AUDIENCE_CHUNK_SIZE, REPROBE_INTERVAL_DAYS
+from database.database import async_session, User, PendingRequest
+
+# Фильтр аудитории хранится в FSM и в payload задачи рассылки как dict:
+#   reprobe          — добавить неактивных, которых давно не перепроверяли
+#   registered_days  — только зарегистрированные за последние N дней
+#   pending_chat_id  — только пользователи с pending-заявкой в этот чат
+# Пустой dict — все активные пользователи.
+
+
+def audience_conditions(audience: dict | None) -> list:
+    audience = audience or {}
+    now = datetime.utcnow()
+    conditions = []
+
+    if audience.get("reprobe"):
+        conditions.append(or_(
+            User.is_active.is_(True),
+            User.probed_at.is_(None),
+            User.probed_at < now - timedelta(days=REPROBE_INTERVAL_DAYS),
+        ))
+    else:
+        conditions.append(User.is_active.is_(True))
+
+    if audience.get("registered_days"):
+        conditions.append(User.created_at >= now - timedelta(days=audience["registered_days"]))
+
+    if audience.get("pending_chat_id"):
+        conditions.append(User.user_id.in_(
+            select(PendingRequest.user_id).where(PendingRequest.chat_id == audience["pending_chat_id"])
+        ))
+
+    return conditions
+
+
+async def count_audience(audience: dict | None) -> int:
+    async with async_session() as db:
+        return await db.scalar(select(func.count()).select_from(User).where(and_(*audience_conditions(audience))))
+
+
+async def iter_audience(audience: dict | None = None, after_id: int = 0, chunk_size: int = AUDIENCE_CHUNK_SIZE):
+    """
+    Постраничное чтение аудитории по users.id (keyset pagination).
+    В памяти держится только одна страница строк (id, user_id, is_active, first_name, username):
+    имя и username нужны для подстановок в тексте рассылки.
+    """
+    conditions = audience_conditions(audience)
+    while True:
+        async with async_session() as db:
+            rows = (await db.execute(
+                select(User.id, User.user_id, User.is_active, User.first_name, User.username)
+                .where(User.id > after_id, *conditions)
+                .order_by(User.id)
+                .limit(chunk_size)
+            )).all()
+        for row in rows:
+            yield row
+        if len(rows) < chunk_size:
+            return
+        after_id = rows[-1].id
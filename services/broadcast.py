@@ -0,0 +1,188 @@
+import asyncio
+import logging
+import time
+from dataclasses import dataclass, field
+from typing import Any, AsyncIterable, Awaitable, Callable, Iterable
+
+from aiogram.exceptions import TelegramRetryAfter
+
+from config import BROADCAST_RATE, BROADCAST_WORKERS
+from services.flood_control import traffic, BULK
+
+logger = logging.getLogger(__name__)
+
+# Результат deliver: отправка отложена в очередь повторов, итог будет учтён позже
+DEFERRED = object()
+
+
+class TokenBucket:
+    """
+    Глобальный лимитер отправок: rate токенов в секунду, запас не больше capacity.
+    pause() останавливает выдачу токенов для всех отправителей сразу (ответ 429 от Telegram).
+    """
+
+    def __init__(self, rate: float, capacity: float | None = None):
+        self.rate = rate
+        # При rate < 1 (растянутая рассылка) запас всё равно должен вмещать целый токен
+        self.capacity = capacity or max(1.0, rate)
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._paused_until = 0.0
+        self._lock = asyncio.Lock()
+
+    def set_rate(self, rate: float):
+        self._refill()
+        self.rate = rate
+        self.capacity = max(1.0, rate)
+        self._tokens = min(self._tokens, self.capacity)
+
+    def pause(self, seconds: float):
+        self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+        self._tokens = 0
+
+    def _refill(self):
+        now = time.monotonic()
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    async def acquire(self):
+        # Лок выстраивает ожидающих в очередь, токены выдаются по порядку
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                if now < self._paused_until:
+                    await asyncio.sleep(self._paused_until - now)
+                    continue
+                self._refill()
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                await asyncio.sleep((1 - self._tokens) / self.rate)
+
+
+async def _aiter(recipients: Iterable[Any] | AsyncIterable[Any]):
+    if hasattr(recipients, "__aiter__"):
+        async for recipient in recipients:
+            yield recipient
+    else:
+        for recipient in recipients:
+            yield recipient
+
+
+@dataclass
+class BroadcastResult:
+    success: int = 0
+    failed: int = 0
+    deferred: int = 0
+    failures: list = field(default_factory=list)  # (получатель, причина) с последнего чекпоинта
+
+    @property
+    def total(self):
+        return self.success + self.failed
+
+
+class BroadcastEngine:
+    """
+    Рассылка пулом параллельных отправителей за общим TokenBucket.
+    deliver(recipient) сам обрабатывает ошибки и возвращает None при успехе, DEFERRED,
+    если отправка ушла в очередь повторов, или текст причины неудачи. TelegramRetryAfter перехватывается здесь:
+    весь лимитер ставится на паузу на указанное Telegram время и отправка повторяется.
+    pause() / resume() / cancel() / limiter.set_rate() можно вызывать во время run().
+    """
+
+    def __init__(self, rate: float = BROADCAST_RATE, workers: int = BROADCAST_WORKERS, max_retries: int = 3):
+        self.limiter = TokenBucket(rate)
+        self.workers = workers
+        self.max_retries = max_retries
+        self.result = BroadcastResult()
+        self.cancelled = False
+        self._resumed = asyncio.Event()
+        self._resumed.set()
+
+    @property
+    def paused(self) -> bool:
+        return not self._resumed.is_set()
+
+    def pause(self):
+        self._resumed.clear()
+
+    def resume(self):
+        self._resumed.set()
+
+    def cancel(self):
+        """Новые получатели больше не берутся, ещё не отправленные из очереди пропускаются"""
+        self.cancelled = True
+        self._resumed.set()
+
+    async def _send(self, recipient: Any, deliver: Callable[[Any], Awaitable[str | None]]) -> str | None:
+        for _ in range(self.max_retries + 1):
+            await self.limiter.acquire()
+            try:
+                return await deliver(recipient)
+            except TelegramRetryAfter as e:
+                logger.warning(f"Flood control: пауза рассылки на {e.retry_after} сек")
+                self.limiter.pause(e.retry_after)
+        return "flood control: превышено число повторов"
+
+    async def run(
+        self,
+        recipients: Iterable[Any] | AsyncIterable[Any],
+        deliver: Callable[[Any], Awaitable[str | None]],
+        on_checkpoint: Callable[[Any, BroadcastResult], Awaitable[None]] | None = None,
+        checkpoint_every: int = 100,
+    ) -> BroadcastResult:
+        """
+        on_checkpoint(last_recipient, result) вызывается каждые checkpoint_every получателей,
+        когда все отправки до last_recipient включительно уже завершены.
+        """
+        result = self.result
+        queue: asyncio.Queue = asyncio.Queue(maxsize=self.workers * 2)
+
+        async def worker():
+            # Запросы рассылки пропускают вперёд ответы пользователям (см. FloodGovernor)
+            traffic.set(BULK)
+            while True:
+                recipient = await queue.get()
+                await self._resumed.wait()
+                if self.cancelled:
+                    queue.task_done()
+                    continue
+                try:
+                    error = await self._send(recipient, deliver)
+                except Exception as e:
+                    logger.exception(f"Неожиданная ошибка в отправителе рассылки: {e}")
+                    error = str(e)
+                if error is None:
+                    result.success += 1
+                elif error is DEFERRED:
+                    result.deferred += 1
+                else:
+                    result.failed += 1
+                    result.failures.append((recipient, error))
+                queue.task_done()
+
+        async def checkpoint(last_recipient):
+            await queue.join()
+            await on_checkpoint(last_recipient, result)
+            result.failures.clear()
+
+        tasks = [asyncio.create_task(worker()) for _ in range(self.workers)]
+        try:
+            fed = 0
+            last_recipient = None
+            async for recipient in _aiter(recipients):
+                if self.cancelled:
+                    break
+                await queue.put(recipient)
+                last_recipient = recipient
+                fed += 1
+                if on_checkpoint and fed % checkpoint_every == 0:
+                    await checkpoint(last_recipient)
+            await queue.join()
+            if on_checkpoint and fed % checkpoint_every:
+                await checkpoint(last_recipient)
+        finally:
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+        return result
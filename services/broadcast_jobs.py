@@ -0,0 +1,274 @@
+import asyncio
+import logging
+import time
+from datetime import datetime
+
+from aiogram.enums import ParseMode
+from aiogram.exceptions import (
+    TelegramBadRequest, TelegramForbiddenError, TelegramNotFound, TelegramAPIError, TelegramRetryAfter
+)
+from sqlalchemy import select, update
+
+from config import BROADCAST_RATE, BROADCAST_CHECKPOINT_EVERY, STATUS_FLUSH_SIZE, STATUS_FLUSH_INTERVAL
+from database.database import async_session, User, BroadcastJob, BroadcastDelivery
+from services.audience import count_audience, iter_audience
+from services.broadcast import BroadcastEngine, BroadcastResult, DEFERRED
+from services.personalize import compile_template
+from services.retry_queue import retry_queue, TRANSIENT_ERRORS
+
+logger = logging.getLogger(__name__)
+
+# Сколько user_id передавать в одном IN (...)
+STATUS_UPDATE_CHUNK = 1000
+# Нижняя граница скорости растянутой рассылки (сообщений в секунду)
+MIN_SPREAD_RATE = 0.05
+
+
+class UserStatusBuffer:
+    """
+    Копит изменения is_active во время рассылки и пишет их пачками:
+    UPDATE users SET is_active=... WHERE user_id IN (...),
+    когда накопилось flush_size изменений или прошло flush_interval секунд.
+    """
+
+    def __init__(self, flush_size: int = STATUS_FLUSH_SIZE, flush_interval: float = STATUS_FLUSH_INTERVAL):
+        self.flush_size = flush_size
+        self.flush_interval = flush_interval
+        self._pending: dict[int, bool] = {}
+        self._last_flush = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    async def mark(self, user_id: int, is_active: bool):
+        self._pending[user_id] = is_active
+        if len(self._pending) >= self.flush_size or time.monotonic() - self._last_flush >= self.flush_interval:
+            await self.flush()
+
+    async def flush(self):
+        async with self._lock:
+            self._last_flush = time.monotonic()
+            if not self._pending:
+                return
+            batch, self._pending = self._pending, {}
+            probed_at = datetime.utcnow()
+            try:
+                async with async_session() as db:
+                    for is_active in (True, False):
+                        user_ids = [user_id for user_id, active in batch.items() if active is is_active]
+                        for i in range(0, len(user_ids), STATUS_UPDATE_CHUNK):
+                            await db.execute(
+                                update(User)
+                                .where(User.user_id.in_(user_ids[i:i + STATUS_UPDATE_CHUNK]))
+                                .values(is_active=is_active, probed_at=probed_at)
+                            )
+                    await db.commit()
+            except Exception as e:
+                logger.error(f"Ошибка при пакетном обновлении is_active ({len(batch)} польз.): {e}")
+                # Возвращаем пачку в буфер до следующего flush, более свежие статусы не перетираем
+                for user_id, is_active in batch.items():
+                    self._pending.setdefault(user_id, is_active)
+
+
+def make_send_deliver(bot, payload: dict, statuses: UserStatusBuffer, defer):
+    """
+    Отправка текста / фото / видео с HTML-разметкой.
+    Текст разбирается в шаблон один раз, для каждого получателя только подставляются его данные.
+    defer(user, call, error) ставит повтор при временной ошибке и возвращает DEFERRED.
+    """
+    template = compile_template(payload["text"]) if payload.get("text") else None
+    media_type = payload.get("media_type")
+    media_file_id = payload.get("media_file_id")
+
+    async def send(user):
+        text = template.render_for(user) if template else None
+        if media_type == "photo" and media_file_id:
+            await bot.send_photo(user.user_id, photo=media_file_id, caption=text, parse_mode=ParseMode.HTML)
+        elif media_type == "video" and media_file_id:
+            await bot.send_video(user.user_id, video=media_file_id, caption=text, parse_mode=ParseMode.HTML)
+        else:
+            await bot.send_message(user.user_id, text=text, parse_mode=ParseMode.HTML)
+
+    async def deliver(user) -> str | None:
+        try:
+            await send(user)
+
+            # Восстановление, если раньше был неактивен
+            if not user.is_active:
+                await statuses.mark(user.user_id, True)
+            return None
+
+        except (TelegramForbiddenError, TelegramNotFound) as e:
+            # бот заблокирован / чат не найден / пользователь неактивен — помечаем неактивным
+            logger.warning(f"Не удалось доставить сообщение пользователю {user.user_id}: {e}")
+            await statuses.mark(user.user_id, False)
+            return str(e)
+
+        except TelegramBadRequest as e:
+            # возможные ошибки формата, недопустимые запросы
+            logger.warning(f"BadRequest при отправке пользователю {user.user_id}: {e}")
+            return str(e)
+
+        except TelegramRetryAfter:
+            # flood control обрабатывает движок рассылки: пауза и повтор
+            raise
+
+        except TRANSIENT_ERRORS as e:
+            # сеть, таймаут, 5xx — повторим позже через очередь повторов
+            return defer(user, lambda: send(user), e)
+
+        except TelegramAPIError as e:
+            # общий класс ошибок API
+            logger.error(f"TelegramAPIError при отправке пользователю {user.user_id}: {e}")
+            return str(e)
+
+        except Exception as e:
+            # все прочие неожиданные ошибки
+            logger.exception(f"Неожиданная ошибка при отправке {user.user_id}: {e}")
+            return str(e)
+
+    return deliver
+
+
+def make_forward_deliver(bot, payload: dict, statuses: UserStatusBuffer, defer):
+    """Пересылка сообщения админа (премиум-эмодзи, любые типы контента)"""
+    from_chat_id = payload["from_chat_id"]
+    message_id = payload["message_id"]
+
+    async def send(user):
+        await bot.forward_message(chat_id=user.user_id, from_chat_id=from_chat_id, message_id=message_id)
+
+    async def deliver(user) -> str | None:
+        try:
+            await send(user)
+            return None
+        except (TelegramForbiddenError, TelegramNotFound) as e:
+            # Помечаем пользователя как неактивного
+            await statuses.mark(user.user_id, False)
+            return str(e)
+        except TelegramRetryAfter:
+            raise
+        except TRANSIENT_ERRORS as e:
+            return defer(user, lambda: send(user), e)
+        except Exception as e:
+            logger.warning(f"Не удалось отправить {user.user_id}: {e}")
+            return str(e)
+
+    return deliver
+
+
+DELIVERS = {
+    "send": make_send_deliver,
+    "forward": make_forward_deliver,
+}
+
+
+def spread_rate(total: int, minutes: int) -> float:
+    """Скорость, при которой total сообщений уйдут примерно за minutes минут (не быстрее BROADCAST_RATE)"""
+    return min(BROADCAST_RATE, max(MIN_SPREAD_RATE, total / (minutes * 60)))
+
+
+async def create_job(kind: str, payload: dict, admin_chat_id: int | None = None,
+                     scheduled_at: datetime | None = None, spread_minutes: int | None = None) -> int:
+    """
+    payload["audience"] — фильтр аудитории (см. services.audience), по умолчанию все активные.
+    С scheduled_at задача ждёт планировщика, со spread_minutes — идёт с пониженной скоростью.
+    """
+    total = await count_audience(payload.get("audience"))
+    async with async_session() as db:
+        job = BroadcastJob(
+            kind=kind, payload=payload, status="scheduled" if scheduled_at else "running",
+            total=total, admin_chat_id=admin_chat_id, scheduled_at=scheduled_at, spread_minutes=spread_minutes,
+            rate=spread_rate(total, spread_minutes) if spread_minutes else None,
+        )
+        db.add(job)
+        await db.commit()
+        return job.id
+
+
+async def run_job(bot, job_id: int, engine: BroadcastEngine | None = None) -> BroadcastJob:
+    """
+    Выполняет (или продолжает с сохранённого курсора) рассылку и возвращает итоговую запись.
+    engine передаёт менеджер рассылок, чтобы управлять ею на ходу (пауза, отмена, скорость).
+    """
+    async with async_session() as db:
+        job = await db.get(BroadcastJob, job_id)
+    if engine is None:
+        engine = BroadcastEngine(rate=job.rate or BROADCAST_RATE)
+
+    if job.cursor:
+        logger.info(f"▶️ Продолжаем рассылку #{job_id} с users.id > {job.cursor}")
+
+    statuses = UserStatusBuffer()
+    saved = BroadcastResult()  # счётчики, уже записанные в БД
+
+    async def on_checkpoint(last_user, result: BroadcastResult):
+        # Сохраняем прогресс: всё до last_user включительно уже обработано.
+        # Счётчики пишем приращениями: их же увеличивают завершившиеся повторы
+        await statuses.flush()
+        async with async_session() as db:
+            await db.execute(update(BroadcastJob).where(BroadcastJob.id == job_id).values(
+                cursor=last_user.id,
+                success=BroadcastJob.success + (result.success - saved.success),
+                failed=BroadcastJob.failed + (result.failed - saved.failed),
+            ))
+            if result.failures:
+                db.add_all([
+                    BroadcastDelivery(job_id=job_id, user_id=user.user_id, error=error[:255])
+                    for user, error in result.failures
+                ])
+            await db.commit()
+        saved.success, saved.failed = result.success, result.failed
+
+    def defer(user, call, error):
+        logger.warning(f"Временная ошибка при отправке {user.user_id}: {error!r}, повтор позже")
+        retry_queue.submit(
+            f"Рассылка #{job_id} → {user.user_id}", call,
+            on_done=lambda retry_error: _apply_retry_outcome(job_id, user.user_id, retry_error)
+        )
+        return DEFERRED
+
+    deliver = DELIVERS[job.kind](bot, job.payload, statuses, defer)
+    try:
+        await engine.run(iter_audience(job.payload.get("audience"), after_id=job.cursor), deliver, on_checkpoint, BROADCAST_CHECKPOINT_EVERY)
+    finally:
+        await statuses.flush()
+
+    async with async_session() as db:
+        await db.execute(update(BroadcastJob).where(BroadcastJob.id == job_id).values(
+            status="cancelled" if engine.cancelled else "done", finished_at=datetime.utcnow()
+        ))
+        await db.commit()
+        job = await db.get(BroadcastJob, job_id)
+    logger.info(f"Рассылка #{job_id} {'отменена' if engine.cancelled else 'завершена'}: "
+                f"успешно={job.success}, неудач={job.failed}")
+    return job
+
+
+async def _apply_retry_outcome(job_id: int, user_id: int, error: BaseException | None):
+    """Учитывает в счётчиках рассылки итог отложенной отправки"""
+    async with async_session() as db:
+        if error is None:
+            await db.execute(update(BroadcastJob).where(BroadcastJob.id == job_id).values(
+                success=BroadcastJob.success + 1
+            ))
+        else:
+            await db.execute(update(BroadcastJob).where(BroadcastJob.id == job_id).values(
+                failed=BroadcastJob.failed + 1
+            ))
+            db.add(BroadcastDelivery(job_id=job_id, user_id=user_id, error=str(error)[:255]))
+            if isinstance(error, (TelegramForbiddenError, TelegramNotFound)):
+                await db.execute(update(User).where(User.user_id == user_id).values(
+                    is_active=False, probed_at=datetime.utcnow()
+                ))
+        await db.commit()
+
+
+async def list_jobs(limit: int = 10) -> list[BroadcastJob]:
+    async with async_session() as db:
+        return (await db.scalars(select(BroadcastJob).order_by(BroadcastJob.id.desc()).limit(limit))).all()
+
+
+def job_progress(job: BroadcastJob) -> int:
+    """Процент выполнения рассылки"""
+    if job.status == "done" or not job.total:
+        return 100
+    return min(100, (job.success + job.failed) * 100 // job.total)
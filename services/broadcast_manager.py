@@ -0,0 +1,235 @@
+import asyncio
+import logging
+import time
+from dataclasses import dataclass, field
+from datetime import datetime
+
+from aiogram.exceptions import TelegramAPIError
+from sqlalchemy import select, update
+
+from config import BROADCAST_RATE, BROADCAST_PROGRESS_INTERVAL, API_RATE
+from database.database import async_session, BroadcastJob
+from keyboard import broadcast_control_kb, main_menu_btn
+from services.broadcast import BroadcastEngine
+from services.broadcast_jobs import run_job, job_progress
+
+logger = logging.getLogger(__name__)
+
+# Границы скорости, которую админ меняет кнопками (сообщений в секунду)
+MIN_RATE = 0.05
+MAX_RATE = API_RATE
+
+
+@dataclass
+class RunningJob:
+    job: BroadcastJob  # запись на момент запуска: счётчики до него, total
+    engine: BroadcastEngine
+    chat_id: int | None
+    message_id: int | None = None
+    last_text: str = ""
+    last_processed: int = 0
+    last_report: float = field(default_factory=time.monotonic)
+    speed: float = 0.0
+    task: asyncio.Task | None = None
+
+
+def progress_text(running: RunningJob) -> str:
+    job, result = running.job, running.engine.result
+    success = job.success + result.success
+    failed = job.failed + result.failed
+    done = success + failed + result.deferred
+    percent = min(100, done * 100 // job.total) if job.total else 100
+    if running.engine.cancelled:
+        header = f"⏹ Рассылка #{job.id} отменяется..."
+    elif running.engine.paused:
+        header = f"⏸ Рассылка #{job.id} на паузе"
+    else:
+        header = f"⏳ Рассылка #{job.id} идёт"
+    return (
+        f"{header}\n\n"
+        f"📨 Успешно: {success * 5}\n"
+        f"⚠️ Ошибок: {failed * 5}\n"
+        f"🔁 В повторах: {result.deferred * 5}\n"
+        f"👥 Обработано: {done * 5} из {job.total * 5} ({percent}%)\n"
+        f"⚡ Скорость: {running.speed:.1f} сообщ./с"
+    )
+
+
+def final_text(job: BroadcastJob) -> str:
+    if job.status == "failed":
+        header = "❌ Рассылка прервана ошибкой"
+    elif job.status == "cancelled":
+        header = "⏹ Рассылка отменена"
+    else:
+        header = "✅ Рассылка завершена!"
+    return (
+        f"{header} (#{job.id}, {job_progress(job)}%)\n\n"
+        f"📨 Успешно: {job.success * 5}\n"
+        f"⚠️ Ошибок: {job.failed * 5}\n"
+        f"👥 Всего пользователей: {job.total * 5}"
+    )
+
+
+class BroadcastManager:
+    """
+    Запускает рассылки фоновыми задачами, раз в interval секунд обновляет
+    одно сообщение с прогрессом у админа и принимает команды: пауза, продолжение,
+    отмена, скорость. Команды пишутся в broadcast_jobs.status / rate, поэтому
+    рассылку, идущую в другом процессе, её процесс подхватит при следующем обновлении.
+    """
+
+    def __init__(self, interval: float = BROADCAST_PROGRESS_INTERVAL):
+        self.interval = interval
+        self.jobs: dict[int, RunningJob] = {}
+
+    async def start(self, bot, job_id: int, chat_id: int | None = None):
+        async with async_session() as db:
+            job = await db.get(BroadcastJob, job_id)
+        engine = BroadcastEngine(rate=job.rate or BROADCAST_RATE)
+        if job.status == "paused":
+            engine.pause()
+        running = RunningJob(job, engine, chat_id)
+        if chat_id:
+            running.last_text = progress_text(running)
+            message = await bot.send_message(chat_id, running.last_text,
+                                             reply_markup=broadcast_control_kb(job_id, engine.paused))
+            running.message_id = message.message_id
+        self.jobs[job_id] = running
+        running.task = asyncio.create_task(self._run(bot, running))
+
+    async def _run(self, bot, running: RunningJob):
+        job_id = running.job.id
+        reporter = asyncio.create_task(self._report(bot, running))
+        try:
+            job = await run_job(bot, job_id, running.engine)
+            text = final_text(job)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.exception(f"Ошибка рассылки #{job_id}: {e}")
+            job = await self._fail(job_id)
+            text = final_text(job) if job else f"❌ Рассылка #{job_id} прервана ошибкой"
+            text += f"\n\n{str(e)[:200]}"
+        finally:
+            reporter.cancel()
+            await asyncio.gather(reporter, return_exceptions=True)
+            self.jobs.pop(job_id, None)
+        try:
+            await self._edit(bot, running, text, main_menu_btn)
+        except Exception as e:
+            logger.error(f"Не удалось сообщить об окончании рассылки #{job_id}: {e}")
+
+    async def _fail(self, job_id: int) -> BroadcastJob | None:
+        """Помечает рассылку failed, чтобы она не висела в running и не возобновлялась после рестарта"""
+        try:
+            async with async_session() as db:
+                await db.execute(update(BroadcastJob).where(BroadcastJob.id == job_id).values(
+                    status="failed", finished_at=datetime.utcnow()
+                ))
+                await db.commit()
+                return await db.get(BroadcastJob, job_id)
+        except Exception as e:
+            logger.error(f"Не удалось пометить рассылку #{job_id} как failed: {e}")
+            return None
+
+    async def _report(self, bot, running: RunningJob):
+        # Ошибка одного обновления не должна останавливать цикл: в нём же синхронизация команд из БД
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                await self._sync(running)
+                result = running.engine.result
+                processed = result.success + result.failed + result.deferred
+                now = time.monotonic()
+                running.speed = (processed - running.last_processed) / (now - running.last_report)
+                running.last_processed, running.last_report = processed, now
+                await self._edit(bot, running, progress_text(running),
+                                 broadcast_control_kb(running.job.id, running.engine.paused))
+            except Exception as e:
+                logger.error(f"Ошибка обновления прогресса рассылки #{running.job.id}: {e}")
+
+    async def _sync(self, running: RunningJob):
+        """Применяет команды, записанные в БД (в том числе другим процессом)"""
+        try:
+            async with async_session() as db:
+                status, rate = (await db.execute(
+                    select(BroadcastJob.status, BroadcastJob.rate).where(BroadcastJob.id == running.job.id)
+                )).one()
+        except Exception as e:
+            logger.error(f"Ошибка чтения состояния рассылки #{running.job.id}: {e}")
+            return
+        self._apply(running.engine, status, rate)
+
+    @staticmethod
+    def _apply(engine: BroadcastEngine, status: str, rate: float | None):
+        if status == "cancelled":
+            engine.cancel()
+        elif status == "paused":
+            engine.pause()
+        elif status == "running":
+            engine.resume()
+        if rate and rate != engine.limiter.rate:
+            engine.limiter.set_rate(rate)
+
+    async def _edit(self, bot, running: RunningJob, text: str, reply_markup):
+        if not running.chat_id or text == running.last_text:
+            return
+        try:
+            await bot.edit_message_text(text, chat_id=running.chat_id, message_id=running.message_id,
+                                        reply_markup=reply_markup)
+            running.last_text = text
+        except TelegramAPIError as e:
+            # сообщение удалено, сеть, исчерпанные повторы 429 — попробуем при следующем обновлении
+            logger.warning(f"Не удалось обновить прогресс рассылки #{running.job.id}: {e}")
+
+    async def control(self, job_id: int, action: str) -> str | None:
+        """
+        action: pause / resume / cancel / slower / faster; отложенную рассылку можно только отменить.
+        Возвращает новый статус рассылки или None, если команда к ней неприменима.
+        """
+        async with async_session() as db:
+            job = await db.get(BroadcastJob, job_id)
+            if job is None or job.status not in ("running", "paused", "scheduled"):
+                return None
+            if job.status == "scheduled" and action != "cancel":
+                return None
+            if action == "pause":
+                job.status = "paused"
+            elif action == "resume":
+                job.status = "running"
+            elif action == "cancel":
+                job.status = "cancelled"
+            elif action in ("slower", "faster"):
+                rate = job.rate or BROADCAST_RATE
+                rate = rate / 2 if action == "slower" else rate * 2
+                job.rate = min(MAX_RATE, max(MIN_RATE, rate))
+            await db.commit()
+            status, rate = job.status, job.rate
+
+        running = self.jobs.get(job_id)
+        if running:
+            self._apply(running.engine, status, rate)
+        return status
+
+    async def resume_jobs(self, bot):
+        """Запускает незавершённые рассылки после рестарта (поставленные на паузу остаются на паузе)"""
+        async with async_session() as db:
+            jobs = (await db.scalars(
+                select(BroadcastJob).where(BroadcastJob.status.in_(["running", "paused"]))
+            )).all()
+        for job in jobs:
+            logger.info(f"🔁 Возобновляем рассылку #{job.id}")
+            try:
+                await self.start(bot, job.id, job.admin_chat_id)
+            except Exception as e:
+                logger.error(f"Ошибка при возобновлении рассылки #{job.id}: {e}")
+
+    async def stop(self):
+        """Останавливает идущие рассылки; они остаются в статусе running и продолжатся после запуска"""
+        tasks = [running.task for running in self.jobs.values() if running.task]
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+
+broadcast_manager = BroadcastManager()
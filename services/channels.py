@@ -0,0 +1,81 @@
+import logging
+from dataclasses import dataclass
+
+from aiogram.types import InlineKeyboardMarkup
+from sqlalchemy import select
+
+from database.database import async_session, Channel, TargetChannel
+from keyboard import start_channels_kb, missing_channels_kb, delete_channels_kb
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass(frozen=True)
+class ChannelInfo:
+    channel_id: int
+    name: str
+    link: str
+
+
+class ChannelRegistry:
+    """
+    Кэш обязательных каналов, целевого канала и построенных по ним клавиатур.
+    Список меняется только из админки, поэтому хендлеры работают
+    с памятью, а add/delete каналов и смена целевого канала вызывают reload().
+    """
+
+    def __init__(self, missing_cache_size: int = 256):
+        self.version = 0
+        self.channels: tuple[ChannelInfo, ...] = ()
+        self.target: ChannelInfo | None = None
+        self.start_kb: InlineKeyboardMarkup | None = None
+        self.delete_kb: InlineKeyboardMarkup | None = None
+        self.list_text = ""
+        self._missing_cache_size = missing_cache_size
+        self._missing_kbs: dict[frozenset, InlineKeyboardMarkup] = {}
+
+    async def load(self):
+        async with async_session() as db:
+            rows = (await db.scalars(select(Channel).order_by(Channel.id))).all()
+            target = await db.scalar(select(TargetChannel))
+        channels = tuple(ChannelInfo(int(ch.channel_id), ch.name, ch.link) for ch in rows)
+
+        if channels:
+            list_text = "📜 Список каналов:\n\n" + "".join(
+                f"➡️ <a href='{ch.link}'>{ch.name}</a>\n" for ch in channels
+            )
+        else:
+            list_text = "📭 Список каналов пуст."
+
+        # Все производные объекты строятся заранее и подменяются вместе
+        self.channels = channels
+        self.target = ChannelInfo(int(target.channel_id), target.name, target.link) if target else None
+        self.start_kb = start_channels_kb(channels)
+        self.delete_kb = delete_channels_kb(channels)
+        self.list_text = list_text
+        self._missing_kbs = {}
+        self.version += 1
+        logger.info(f"✅ Загружено обязательных каналов: {len(channels)} (версия {self.version})")
+
+    reload = load
+
+    @property
+    def pending_channels(self) -> tuple[ChannelInfo, ...]:
+        """Каналы, заявки в которые хранятся в pending: целевой и обязательные, без повторов"""
+        if self.target is None:
+            return self.channels
+        return (self.target,) + tuple(ch for ch in self.channels if ch.channel_id != self.target.channel_id)
+
+    def missing_kb(self, missing: list[ChannelInfo]) -> InlineKeyboardMarkup:
+        """Клавиатура для набора неподписанных каналов, кэшируется по этому набору"""
+        key = frozenset(ch.channel_id for ch in missing)
+        kb = self._missing_kbs.get(key)
+        if kb is None:
+            if len(self._missing_kbs) >= self._missing_cache_size:
+                self._missing_kbs.clear()
+            kb = missing_channels_kb(missing)
+            self._missing_kbs[key] = kb
+        return kb
+
+
+channel_registry = ChannelRegistry()
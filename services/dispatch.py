@@ -0,0 +1,100 @@
+import asyncio
+import logging
+import statistics
+import time
+from collections import deque
+from typing import Any, Awaitable, Callable, Dict
+
+from aiogram import BaseMiddleware
+from aiogram.types import Update
+
+from config import UPDATE_WORKERS, UPDATE_MAX_PENDING
+from services.sharding import routing_key
+
+logger = logging.getLogger(__name__)
+
+
+class UserLanes(BaseMiddleware):
+    """
+    Outer-middleware апдейтов: у каждого пользователя своя очередь.
+    Апдейты разных пользователей выполняются параллельно (не больше workers одновременно),
+    апдейты одного пользователя — строго по порядку поступления, поэтому переходы FSM
+    и повторные нажатия кнопок не обгоняют друг друга.
+
+    Диспетчер только ставит апдейт в очередь и сразу возвращается. Если в очередях уже
+    max_pending апдейтов, постановка ждёт освобождения места — polling перестаёт
+    забирать новые апдейты, и они копятся на стороне Telegram, а не в памяти.
+    """
+
+    def __init__(self, workers: int = UPDATE_WORKERS, max_pending: int = UPDATE_MAX_PENDING):
+        self._semaphore = asyncio.Semaphore(workers)
+        self._slots = asyncio.Semaphore(max_pending)
+        self._lanes: dict[int, deque] = {}
+        self._tasks: set[asyncio.Task] = set()
+        self._waits = deque(maxlen=1000)  # время ожидания последних апдейтов (сек)
+        self.queued = 0
+        self.running = 0
+
+    async def __call__(
+        self,
+        handler: Callable[[Update, Dict[str, Any]], Awaitable[Any]],
+        event: Update,
+        data: Dict[str, Any],
+    ) -> Any:
+        await self._slots.acquire()
+        key = routing_key(event)
+        # Время поступления доступно хендлерам как аргумент received_at
+        data["received_at"] = time.monotonic()
+        item = (handler, event, data, data["received_at"])
+        self.queued += 1
+        lane = self._lanes.get(key)
+        if lane is not None:
+            lane.append(item)
+            return
+        self._lanes[key] = deque([item])
+        task = asyncio.create_task(self._run_lane(key))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _run_lane(self, key: int):
+        lane = self._lanes[key]
+        try:
+            while lane:
+                handler, event, data, queued_at = lane[0]
+                async with self._semaphore:
+                    self._waits.append(time.monotonic() - queued_at)
+                    self.queued -= 1
+                    self.running += 1
+                    try:
+                        # FSMContextMiddleware прочитал состояние ещё при постановке в очередь;
+                        # предыдущий апдейт этого пользователя мог его сменить
+                        if "state" in data:
+                            data["raw_state"] = await data["state"].get_state()
+                        await handler(event, data)
+                    except Exception:
+                        logger.exception(f"Ошибка обработки апдейта {event.update_id}")
+                    finally:
+                        self.running -= 1
+                lane.popleft()
+                self._slots.release()
+        finally:
+            del self._lanes[key]
+
+    def stats(self) -> dict:
+        """Глубина очереди и время ожидания апдейтов (по последним 1000)"""
+        waits = list(self._waits)
+        return {
+            "queued": self.queued,
+            "running": self.running,
+            "lanes": len(self._lanes),
+            "wait_p50": statistics.median(waits) if waits else 0.0,
+            "wait_max": max(waits, default=0.0),
+        }
+
+    async def drain(self):
+        """Дожидается обработки всех поставленных в очередь апдейтов"""
+        while self._tasks:
+            await asyncio.gather(*self._tasks, return_exceptions=True)
+
+
+update_lanes = UserLanes()
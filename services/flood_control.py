@@ -0,0 +1,175 @@
+import asyncio
+import contextvars
+import logging
+import time
+from collections import deque
+
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware
+from aiogram.exceptions import TelegramRetryAfter
+
+from config import API_RATE, API_PRIVATE_CHAT_RATE, API_GROUP_CHAT_RATE, API_CHAT_BURST, API_MAX_RETRIES, WORKERS
+
+logger = logging.getLogger(__name__)
+
+INTERACTIVE = "interactive"
+BULK = "bulk"
+
+# Класс трафика текущей задачи: ответы пользователям по умолчанию, рассылка помечает себя как BULK
+traffic = contextvars.ContextVar("traffic", default=INTERACTIVE)
+
+# Методы без лимитов: long polling и настройка вебхука
+UNLIMITED_METHODS = {"getUpdates", "getMe", "setWebhook", "deleteWebhook", "close", "logOut"}
+# Методы, которые пишут в чат: только они расходуют общий лимит сообщений и лимит "сообщений в чат".
+# Чтение и служебные вызовы (getChatMember, answerCallbackQuery, approveChatJoinRequest...) идут без очереди
+CHAT_METHOD_PREFIXES = ("send", "forward", "copy", "edit")
+# Сколько чатов хранить в лимитере, прежде чем выкинуть уже восстановившиеся
+CHAT_BUCKETS_PRUNE_AT = 10000
+
+
+class PriorityBucket:
+    """
+    Общий лимитер отправок в Bot API: rate токенов в секунду.
+    Ожидающие выстраиваются в две очереди, и интерактивные запросы всегда
+    получают токен раньше массовых. pause() останавливает выдачу всем (ответ 429).
+    """
+
+    def __init__(self, rate: float):
+        self.rate = rate
+        self.capacity = rate
+        self._tokens = rate
+        self._updated = time.monotonic()
+        self._paused_until = 0.0
+        self._waiters = {INTERACTIVE: deque(), BULK: deque()}
+        self._dispatcher: asyncio.Task | None = None
+
+    def pause(self, seconds: float):
+        self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+        self._tokens = 0
+
+    def _take(self) -> bool:
+        now = time.monotonic()
+        if now < self._paused_until:
+            return False
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+        if self._tokens >= 1:
+            self._tokens -= 1
+            return True
+        return False
+
+    def waiting(self, priority: str) -> int:
+        return len(self._waiters[priority])
+
+    async def acquire(self, priority: str = INTERACTIVE):
+        if not self._waiters[INTERACTIVE] and not self._waiters[BULK] and self._take():
+            return
+        future = asyncio.get_running_loop().create_future()
+        self._waiters[priority].append(future)
+        if self._dispatcher is None or self._dispatcher.done():
+            self._dispatcher = asyncio.create_task(self._dispatch())
+        await future
+
+    async def _dispatch(self):
+        """Раздаёт токены ожидающим: сначала интерактивным, потом массовым"""
+        while True:
+            queue = self._waiters[INTERACTIVE] or self._waiters[BULK]
+            while queue and queue[0].done():  # ожидающий отменён
+                queue.popleft()
+            if not queue:
+                if not self._waiters[INTERACTIVE] and not self._waiters[BULK]:
+                    return
+                continue
+            if self._take():
+                queue.popleft().set_result(None)
+                continue
+            now = time.monotonic()
+            if now < self._paused_until:
+                await asyncio.sleep(self._paused_until - now)
+            else:
+                await asyncio.sleep((1 - self._tokens) / self.rate)
+
+
+class ChatLimiter:
+    """Лимит сообщений в один чат: небольшой запас burst, дальше rate в секунду"""
+
+    def __init__(self, private_rate: float, group_rate: float, burst: float):
+        self.private_rate = private_rate
+        self.group_rate = group_rate
+        self.burst = burst
+        self._buckets: dict[int | str, tuple[float, float]] = {}  # chat_id -> (токены, время)
+
+    def _rate(self, chat_id) -> float:
+        # Отрицательные id и @username — группы и каналы
+        return self.private_rate if isinstance(chat_id, int) and chat_id > 0 else self.group_rate
+
+    def reserve(self, chat_id) -> float:
+        """Занимает отправку в чат и возвращает, сколько секунд до неё нужно подождать"""
+        rate = self._rate(chat_id)
+        now = time.monotonic()
+        tokens, updated = self._buckets.get(chat_id, (self.burst, now))
+        tokens = min(self.burst, tokens + (now - updated) * rate) - 1
+        self._buckets[chat_id] = (tokens, now)
+        if len(self._buckets) > CHAT_BUCKETS_PRUNE_AT:
+            self._prune(now)
+        return -tokens / rate if tokens < 0 else 0.0
+
+    def _prune(self, now: float):
+        for chat_id, (tokens, updated) in list(self._buckets.items()):
+            if tokens + (now - updated) * self._rate(chat_id) >= self.burst:
+                del self._buckets[chat_id]
+
+
+class FloodGovernor(BaseRequestMiddleware):
+    """
+    Request-middleware сессии бота: отправки сообщений проходят через общий лимитер
+    (интерактивные вне очереди перед рассылкой) и лимит сообщений в чат.
+    Лимитер общий для процесса: при нескольких воркерах бюджет API_RATE делится между ними.
+    На 429 при отправке весь лимитер встаёт на паузу retry_after, прочий запрос просто ждёт;
+    запрос повторяется до max_retries раз.
+    """
+
+    def __init__(self, rate: float = API_RATE / max(1, WORKERS), private_chat_rate: float = API_PRIVATE_CHAT_RATE,
+                 group_chat_rate: float = API_GROUP_CHAT_RATE, chat_burst: float = API_CHAT_BURST,
+                 max_retries: int = API_MAX_RETRIES):
+        self.bucket = PriorityBucket(rate)
+        self.chats = ChatLimiter(private_chat_rate, group_chat_rate, chat_burst)
+        self.max_retries = max_retries
+        self.flood_waits = 0
+
+    async def __call__(self, make_request, bot, method):
+        api_method = method.__api_method__
+        if api_method in UNLIMITED_METHODS:
+            return await make_request(bot, method)
+
+        sends = api_method.startswith(CHAT_METHOD_PREFIXES)
+        chat_id = getattr(method, "chat_id", None)
+        if chat_id is not None and sends:
+            delay = self.chats.reserve(chat_id)
+            if delay:
+                await asyncio.sleep(delay)
+
+        priority = traffic.get()
+        for attempt in range(self.max_retries + 1):
+            if sends:
+                await self.bucket.acquire(priority)
+            try:
+                return await make_request(bot, method)
+            except TelegramRetryAfter as e:
+                self.flood_waits += 1
+                if attempt == self.max_retries:
+                    raise
+                logger.warning(f"Flood control: {api_method} ({priority}), пауза {e.retry_after} сек")
+                if sends:
+                    self.bucket.pause(e.retry_after)
+                else:
+                    await asyncio.sleep(e.retry_after)
+
+    def stats(self) -> dict:
+        return {
+            "interactive_waiting": self.bucket.waiting(INTERACTIVE),
+            "bulk_waiting": self.bucket.waiting(BULK),
+            "flood_waits": self.flood_waits,
+        }
+
+
+flood_governor = FloodGovernor()
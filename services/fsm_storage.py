@@ -0,0 +1,213 @@
+import asyncio
+import logging
+import time
+from copy import copy
+from dataclasses import dataclass, field
+from datetime import datetime, timedelta
+from typing import Any, Dict, Mapping, Optional
+
+from aiogram.exceptions import DataNotDictLikeError
+from aiogram.fsm.state import State
+from aiogram.fsm.storage.base import BaseStorage, StateType, StorageKey, DEFAULT_DESTINY
+from sqlalchemy import delete
+
+from config import FSM_STATE_TTL, FSM_FLUSH_INTERVAL, FSM_CACHE_MAX_ENTRIES
+from database.database import async_session, FsmRecord, upsert_fsm_records
+
+logger = logging.getLogger(__name__)
+
+# Строк в одном многострочном INSERT / ключей в одном DELETE ... IN
+INSERT_CHUNK = 500
+# Как часто удалять из БД брошенные состояния (сек)
+SWEEP_INTERVAL = 600
+
+
+def compact_key(key: StorageKey) -> str:
+    """
+    Ключ записи: "chat_id:user_id", остальные части — только если заданы.
+    bot_id не храним: у базы один бот.
+    """
+    parts = [str(key.chat_id), str(key.user_id)]
+    if key.thread_id:
+        parts.append(f"t{key.thread_id}")
+    if key.business_connection_id:
+        parts.append(f"b{key.business_connection_id}")
+    if key.destiny != DEFAULT_DESTINY:
+        parts.append(f"d{key.destiny}")
+    return ":".join(parts)
+
+
+@dataclass
+class _Record:
+    state: Optional[str] = None
+    data: Dict[str, Any] = field(default_factory=dict)
+    changed: float = field(default_factory=time.monotonic)  # время последнего изменения (monotonic)
+
+    @property
+    def empty(self) -> bool:
+        return self.state is None and not self.data
+
+
+class SQLStorage(BaseStorage):
+    """
+    FSM-хранилище в общей БД: состояния админских диалогов переживают перезапуск.
+    Чтения обслуживает кэш процесса (апдейты одного пользователя всегда попадают
+    в один процесс), изменения пишутся в БД пачкой по таймеру.
+    Состояния, не менявшиеся дольше ttl, считаются брошенными и удаляются.
+    """
+
+    def __init__(self, ttl: float = FSM_STATE_TTL, flush_interval: float = FSM_FLUSH_INTERVAL,
+                 max_entries: int = FSM_CACHE_MAX_ENTRIES):
+        self.ttl = ttl
+        self.flush_interval = flush_interval
+        self.max_entries = max_entries
+        self._cache: dict[str, _Record] = {}  # порядок ключей = порядок обращений (LRU)
+        self._dirty: set[str] = set()
+        self._flushing: set[str] = set()  # ключи, чья запись в БД сейчас идёт: из кэша не выкидываются
+        self._failed: dict[str, dict | None] = {}  # снимки неудавшейся записи: ключ -> строка (None — удалить)
+        self._task: asyncio.Task | None = None
+
+    # --- Кэш ---
+
+    async def _load(self, key: str) -> _Record:
+        async with async_session() as db:
+            row = await db.get(FsmRecord, key)
+        if row is None:
+            return _Record()
+        age = (datetime.utcnow() - row.updated_at).total_seconds()
+        if age > self.ttl:
+            return _Record()
+        return _Record(row.state, row.data or {}, time.monotonic() - age)
+
+    async def _get(self, key: str) -> _Record:
+        record = self._cache.pop(key, None)
+        if record is None:
+            loaded = await self._load(key)
+            # Пока шла загрузка, параллельный апдейт мог уже записать состояние
+            record = self._cache.pop(key, None) or loaded
+        elif time.monotonic() - record.changed > self.ttl:
+            record = _Record()
+            self._dirty.add(key)
+        self._cache[key] = record
+        if len(self._cache) > self.max_entries:
+            self._evict()
+        return record
+
+    def _evict(self):
+        """Выкидывает давно не читавшиеся записи, ещё не записанные в БД оставляет"""
+        target = int(self.max_entries * 0.9)
+        for key in list(self._cache):
+            if len(self._cache) <= target:
+                break
+            if key not in self._dirty and key not in self._flushing and key not in self._failed:
+                del self._cache[key]
+
+    def _changed(self, key: str, record: _Record):
+        record.changed = time.monotonic()
+        self._dirty.add(key)
+
+    # --- BaseStorage ---
+
+    async def set_state(self, key: StorageKey, state: StateType = None) -> None:
+        k = compact_key(key)
+        record = await self._get(k)
+        record.state = state.state if isinstance(state, State) else state
+        self._changed(k, record)
+
+    async def get_state(self, key: StorageKey) -> Optional[str]:
+        return (await self._get(compact_key(key))).state
+
+    async def set_data(self, key: StorageKey, data: Mapping[str, Any]) -> None:
+        if not isinstance(data, dict):
+            raise DataNotDictLikeError(
+                f"Data must be a dict or dict-like object, got {type(data).__name__}"
+            )
+        k = compact_key(key)
+        record = await self._get(k)
+        record.data = data.copy()
+        self._changed(k, record)
+
+    async def get_data(self, key: StorageKey) -> Dict[str, Any]:
+        return (await self._get(compact_key(key))).data.copy()
+
+    async def get_value(self, storage_key: StorageKey, dict_key: str, default: Optional[Any] = None) -> Optional[Any]:
+        data = (await self._get(compact_key(storage_key))).data
+        return copy(data.get(dict_key, default))
+
+    async def close(self) -> None:
+        await self.stop()
+
+    # --- Запись в БД ---
+
+    async def flush(self):
+        if not self._dirty and not self._failed:
+            return
+        keys, self._dirty = self._dirty, set()
+        # Снимки прошлой неудачной записи; ключи, изменённые с тех пор, перезаписываются свежими
+        snapshots, self._failed = self._failed, {}
+        now = datetime.utcnow()
+        for key in keys:
+            record = self._cache[key]
+            snapshots[key] = None if record.empty else {
+                "key": key, "state": record.state, "data": record.data.copy(), "updated_at": now
+            }
+        rows = [row for row in snapshots.values() if row is not None]
+        cleared = [key for key, row in snapshots.items() if row is None]
+        self._flushing |= snapshots.keys()
+        try:
+            async with async_session() as db:
+                for i in range(0, len(rows), INSERT_CHUNK):
+                    await upsert_fsm_records(db, rows[i:i + INSERT_CHUNK])
+                for i in range(0, len(cleared), INSERT_CHUNK):
+                    await db.execute(delete(FsmRecord).where(FsmRecord.key.in_(cleared[i:i + INSERT_CHUNK])))
+                await db.commit()
+        except Exception as e:
+            logger.error(f"Ошибка записи состояний FSM ({len(snapshots)}): {e}")
+            # Повторим те же снимки; изменённые за время записи ключи уже снова в _dirty
+            for key, row in snapshots.items():
+                self._failed.setdefault(key, row)
+        finally:
+            self._flushing -= snapshots.keys()
+
+    async def sweep(self):
+        """Удаляет брошенные состояния из БД и из кэша"""
+        deadline = time.monotonic() - self.ttl
+        protected = self._dirty | self._flushing | self._failed.keys()
+        for key in [k for k, r in self._cache.items() if r.changed < deadline and k not in protected]:
+            del self._cache[key]
+        async with async_session() as db:
+            result = await db.execute(delete(FsmRecord).where(
+                FsmRecord.updated_at < datetime.utcnow() - timedelta(seconds=self.ttl)
+            ))
+            await db.commit()
+        if result.rowcount:
+            logger.info(f"🧹 Удалено брошенных состояний FSM: {result.rowcount}")
+
+    async def _run(self):
+        last_sweep = 0.0
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            try:
+                await self.flush()
+            except Exception as e:
+                logger.error(f"Ошибка фоновой записи состояний FSM: {e}")
+            if time.monotonic() - last_sweep >= SWEEP_INTERVAL:
+                last_sweep = time.monotonic()
+                try:
+                    await self.sweep()
+                except Exception as e:
+                    logger.error(f"Ошибка очистки состояний FSM: {e}")
+
+    def start(self):
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        """Останавливает фоновую запись и сбрасывает несохранённые состояния в БД"""
+        if self._task:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+        await self.flush()
+
+
+fsm_storage = SQLStorage()
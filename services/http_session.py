@@ -0,0 +1,71 @@
+import logging
+
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.exceptions import TelegramNetworkError
+
+from config import API_POOL_SIZE, API_KEEPALIVE, API_DNS_TTL, API_TIMEOUT, API_FAST_TIMEOUT, API_MEDIA_TIMEOUT
+
+logger = logging.getLogger(__name__)
+
+# Короткие запросы, по которым пользователь ждёт ответа: долго ждать их нет смысла
+FAST_METHODS = {"getChatMember", "answerCallbackQuery", "approveChatJoinRequest", "declineChatJoinRequest"}
+# Отправка медиа: Telegram может долго скачивать файл по file_id / URL
+MEDIA_METHODS = {"sendPhoto", "sendVideo", "sendDocument", "sendAnimation", "sendMediaGroup", "copyMessage",
+                 "forwardMessage"}
+
+
+class TunedAiohttpSession(AiohttpSession):
+    """
+    AiohttpSession с настраиваемым пулом соединений к api.telegram.org:
+    размер пула, keep-alive простаивающих соединений, кэш DNS
+    и таймауты по группам методов. Считает занятость пула.
+    """
+
+    def __init__(self, pool_size: int = API_POOL_SIZE, keepalive: float = API_KEEPALIVE,
+                 dns_ttl: int = API_DNS_TTL, timeout: float = API_TIMEOUT,
+                 fast_timeout: float = API_FAST_TIMEOUT, media_timeout: float = API_MEDIA_TIMEOUT):
+        super().__init__(limit=pool_size, timeout=timeout)
+        # Все запросы идут на один хост, поэтому лимит на хост равен размеру пула
+        self._connector_init.update(
+            limit_per_host=pool_size,
+            keepalive_timeout=keepalive,
+            ttl_dns_cache=dns_ttl,
+        )
+        self.pool_size = pool_size
+        self.method_timeouts = {
+            **{name: fast_timeout for name in FAST_METHODS},
+            **{name: media_timeout for name in MEDIA_METHODS},
+        }
+        self.in_flight = 0
+        self.peak_in_flight = 0
+        self.requests = 0
+        self.network_errors = 0
+
+    async def make_request(self, bot, method, timeout=None):
+        # Явный таймаут (например, у getUpdates при long polling) не трогаем
+        if timeout is None:
+            if method.__api_method__ == "getUpdates":
+                # long poll без явного таймаута: ждём сам опрос плюс обычный таймаут запроса
+                timeout = (method.timeout or 0) + self.timeout
+            else:
+                timeout = self.method_timeouts.get(method.__api_method__, self.timeout)
+        self.requests += 1
+        self.in_flight += 1
+        self.peak_in_flight = max(self.peak_in_flight, self.in_flight)
+        try:
+            return await super().make_request(bot, method, timeout)
+        except TelegramNetworkError:
+            self.network_errors += 1
+            raise
+        finally:
+            self.in_flight -= 1
+
+    def stats(self) -> dict:
+        """Занятость пула: запросов в работе сейчас и максимум с запуска"""
+        return {
+            "pool_size": self.pool_size,
+            "in_flight": self.in_flight,
+            "peak_in_flight": self.peak_in_flight,
+            "requests": self.requests,
+            "network_errors": self.network_errors,
+        }
@@ -0,0 +1,46 @@
+import logging
+from typing import Callable
+
+from services.channels import channel_registry
+from services.scheduler import scheduler
+from services.templates import templates
+
+logger = logging.getLogger(__name__)
+
+
+async def _wake_scheduler():
+    # Расписание ведёт только воркер 0, в остальных событие просто никто не ждёт
+    scheduler.wake()
+
+
+# Что перезагружать при получении события об изменении из другого процесса
+RELOADERS = {
+    "templates": templates.reload,
+    "channels": channel_registry.reload,
+    "scheduler": _wake_scheduler,
+}
+
+_publisher: Callable[[str], None] | None = None
+
+
+def set_publisher(publisher: Callable[[str], None]):
+    """В многопроцессном режиме воркер передаёт сюда отправку события в родительский процесс"""
+    global _publisher
+    _publisher = publisher
+
+
+def publish(kind: str):
+    """
+    Сообщает остальным процессам, что кэш kind изменился в БД.
+    В однопроцессном режиме ничего не делает — локальный кэш уже обновлён.
+    """
+    if _publisher:
+        _publisher(kind)
+
+
+async def apply(kind: str):
+    reload = RELOADERS.get(kind)
+    if reload is None:
+        logger.warning(f"Неизвестное событие инвалидации: {kind}")
+        return
+    await reload()
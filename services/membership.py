@@ -0,0 +1,53 @@
+import time
+
+from config import MEMBERSHIP_TTL, MEMBERSHIP_NEGATIVE_TTL, MEMBERSHIP_MAX_ENTRIES
+
+
+class MembershipStore:
+    """
+    Локальное зеркало подписок пользователей: (user_id, chat_id) -> (подписан, истекает_в).
+    Наполняется из апдейтов chat_member, одобренных заявок и ответов get_chat_member.
+    Просроченная или отсутствующая запись означает, что нужно спросить API.
+    """
+
+    def __init__(self, ttl: float, negative_ttl: float, max_entries: int):
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.max_entries = max_entries
+        self._entries: dict[tuple[int, int], tuple[bool, float]] = {}
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, user_id: int, chat_id: int) -> bool | None:
+        key = (user_id, chat_id)
+        entry = self._entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+        is_member, expires_at = entry
+        if expires_at < time.monotonic():
+            del self._entries[key]
+            self.misses += 1
+            return None
+        self.hits += 1
+        return is_member
+
+    def set(self, user_id: int, chat_id: int, is_member: bool, ttl: float | None = None):
+        if ttl is None:
+            ttl = self.ttl
+        key = (user_id, chat_id)
+        # Переставляем ключ в конец, чтобы вытеснялись самые старые записи
+        self._entries.pop(key, None)
+        if len(self._entries) >= self.max_entries:
+            self._entries.pop(next(iter(self._entries)))
+        self._entries[key] = (is_member, time.monotonic() + ttl)
+
+    def set_from_api(self, user_id: int, chat_id: int, is_member: bool):
+        """Результат get_chat_member: отрицательный ответ живёт недолго, чтобы не мешать свежей подписке"""
+        self.set(user_id, chat_id, is_member, self.ttl if is_member else self.negative_ttl)
+
+    def __len__(self):
+        return len(self._entries)
+
+
+membership = MembershipStore(MEMBERSHIP_TTL, MEMBERSHIP_NEGATIVE_TTL, MEMBERSHIP_MAX_ENTRIES)
@@ -0,0 +1,58 @@
+import html
+import re
+from functools import lru_cache
+
+# Подстановки в шаблонах рассылок и сообщений: значения берутся из строки users / Telegram User
+FIELDS = ("first_name", "username")
+PLACEHOLDER_RE = re.compile(r"\{(" + "|".join(FIELDS) + r")\}")
+
+
+class Template:
+    """
+    HTML-шаблон, разобранный один раз: список сегментов, где на нечётных местах стоят
+    подстановки, а на чётных — готовый (уже экранированный) HTML.
+    Рендер для получателя — вставить значения в копию списка и склеить.
+    Остальные фигурные скобки в тексте остаются как есть.
+    """
+
+    __slots__ = ("source", "_segments", "_slots")
+
+    def __init__(self, source: str):
+        self.source = source
+        self._segments = PLACEHOLDER_RE.split(source)
+        self._slots = tuple((i, self._segments[i]) for i in range(1, len(self._segments), 2))
+
+    @property
+    def personal(self) -> bool:
+        """Есть ли в шаблоне подстановки (иначе рендер возвращает source)"""
+        return bool(self._slots)
+
+    def render(self, fields: dict[str, str]) -> str:
+        """fields — результат user_fields(): значения уже экранированы"""
+        if not self._slots:
+            return self.source
+        segments = self._segments.copy()
+        for i, name in self._slots:
+            segments[i] = fields[name]
+        return "".join(segments)
+
+    def render_for(self, user) -> str:
+        return self.render(user_fields(user)) if self._slots else self.source
+
+
+@lru_cache(maxsize=256)
+def compile_template(source: str) -> Template:
+    return Template(source)
+
+
+def user_fields(user) -> dict[str, str]:
+    """
+    Значения подстановок для получателя, экранированные для parse_mode=HTML.
+    user — строка users, строка аудитории рассылки или aiogram User.
+    """
+    username = user.username
+    return {
+        "first_name": html.escape(user.first_name or ""),
+        # В users отсутствующий username хранится строкой "None"
+        "username": html.escape(username) if username and username != "None" else "",
+    }
@@ -0,0 +1,119 @@
+import html
+import re
+from bisect import bisect_left
+
+# Сущности, которые превращаются в парные теги без атрибутов
+SIMPLE_TAGS = {
+    "bold": ("<b>", "</b>"),
+    "italic": ("<i>", "</i>"),
+    "underline": ("<u>", "</u>"),
+    "strikethrough": ("<s>", "</s>"),
+    "spoiler": ("<tg-spoiler>", "</tg-spoiler>"),
+    "code": ("<code>", "</code>"),
+    "blockquote": ("<blockquote>", "</blockquote>"),
+    "expandable_blockquote": ("<blockquote expandable>", "</blockquote>"),
+}
+# mention, hashtag, cashtag, bot_command, email, phone_number и т.п. Telegram
+# распознаёт в тексте сам, поэтому они выводятся обычным текстом
+
+OPEN, CLOSE = 1, 0
+# Символы вне BMP: в UTF-16 занимают две единицы (суррогатная пара)
+ASTRAL_RE = re.compile("[\U00010000-\U0010FFFF]")
+
+
+def _index(offset: int, astral: list[int]) -> int:
+    """UTF-16 offset -> индекс в строке"""
+    return offset - bisect_left(astral, offset)
+
+
+def _tags(ent: dict, text: str, astral: list[int]) -> tuple[str, str] | None:
+    """Открывающий и закрывающий тег сущности или None, если она выводится как текст"""
+    t = ent["type"]
+    if t == "text_link" and ent.get("url"):
+        return f'<a href="{html.escape(ent["url"])}">', "</a>"
+    if t == "url":
+        start = _index(ent["offset"], astral)
+        url = text[start:_index(ent["offset"] + ent["length"], astral)]
+        return f'<a href="{html.escape(url)}">', "</a>"
+    if t == "text_mention" and ent.get("user"):
+        return f'<a href="tg://user?id={int(ent["user"]["id"])}">', "</a>"
+    if t == "custom_emoji" and ent.get("custom_emoji_id"):
+        return f'<tg-emoji emoji-id="{html.escape(ent["custom_emoji_id"])}">', "</tg-emoji>"
+    if t == "pre":
+        if ent.get("language"):
+            return f'<pre><code class="language-{html.escape(ent["language"])}">', "</code></pre>"
+        return "<pre>", "</pre>"
+    return None
+
+
+def entities_to_html(text: str, entities: list | None) -> str:
+    """
+    Конвертирует text + entities (словари, см. entity_dicts) в HTML для parse_mode=HTML.
+    Offset/length у Telegram в UTF-16: символы вне BMP (эмодзи) занимают две единицы,
+    поэтому границы сущностей переводятся в индексы строки по списку таких символов.
+    Границы — отсортированный список событий "открыть/закрыть тег", текст между ними
+    экранируется один раз. Вложенные сущности закрываются раньше внешних,
+    а пересекающиеся закрываются и открываются заново, чтобы теги оставались правильно вложенными.
+    """
+    if not entities:
+        return html.escape(text)
+
+    # UTF-16 offset каждого символа вне BMP (его индекс в строке + число таких символов до него)
+    astral = [m.start() + n for n, m in enumerate(ASTRAL_RE.finditer(text))]
+    size = len(text) + len(astral)
+    opens, closes = [], []
+    events = []
+    for ent in entities:
+        start = max(0, ent["offset"])
+        end = min(size, ent["offset"] + ent["length"])
+        if start >= end:
+            continue
+        pair = SIMPLE_TAGS.get(ent["type"]) or _tags(ent, text, astral)
+        if pair is None:
+            continue
+        i = len(opens)
+        opens.append(pair[0])
+        closes.append(pair[1])
+        if astral:
+            start = _index(start, astral)
+            end = _index(end, astral)
+        # В одной позиции сначала закрытия, потом открытия: длинная сущность открывается первой,
+        # а закрывается первой та, что открыта позже
+        events.append((start, OPEN, -end, i, i))
+        events.append((end, CLOSE, -start, -i, i))
+    events.sort()
+
+    escape = html.escape
+    parts = []
+    append = parts.append
+    stack = []
+    pos = 0
+    for at, kind, _, _, i in events:
+        if at > pos:
+            append(escape(text[pos:at]))
+            pos = at
+        if kind == OPEN:
+            append(opens[i])
+            stack.append(i)
+        elif stack[-1] == i:
+            append(closes[stack.pop()])
+        else:
+            # Пересечение: закрываем всё, что открыто внутри i, затем i и снова открываем остальные
+            reopen = []
+            while (j := stack.pop()) != i:
+                append(closes[j])
+                reopen.append(j)
+            append(closes[i])
+            for j in reversed(reopen):
+                append(opens[j])
+                stack.append(j)
+
+    append(escape(text[pos:]))
+    return "".join(parts)
+
+
+def entity_dicts(entities: list | None) -> list[dict] | None:
+    """MessageEntity aiogram -> словари для БД и entities_to_html (со всеми полями сущности)"""
+    if not entities:
+        return None
+    return [e.model_dump(mode="json", exclude_none=True) for e in entities]
@@ -0,0 +1,163 @@
+import asyncio
+import heapq
+import itertools
+import logging
+import random
+import time
+from collections import deque
+from dataclasses import dataclass, field
+from datetime import datetime
+from typing import Awaitable, Callable
+
+from aiogram.exceptions import TelegramNetworkError, TelegramRetryAfter, TelegramServerError
+
+from config import RETRY_MAX_ATTEMPTS, RETRY_BASE_DELAY, RETRY_MAX_DELAY, RETRY_DEAD_LETTER_SIZE
+from services.flood_control import traffic
+
+logger = logging.getLogger(__name__)
+
+# Ошибки, после которых есть смысл повторить запрос позже:
+# сеть/таймаут, 5xx от Telegram и 429, который не помог переждать FloodGovernor
+TRANSIENT_ERRORS = (TelegramNetworkError, TelegramServerError, TelegramRetryAfter, asyncio.TimeoutError, OSError)
+
+
+def is_transient(error: BaseException) -> bool:
+    return isinstance(error, TRANSIENT_ERRORS)
+
+
+class RetryAbandoned(Exception):
+    """Итог повтора, который не успел выполниться до остановки очереди"""
+
+
+@dataclass
+class RetryItem:
+    name: str
+    call: Callable[[], Awaitable]
+    on_done: Callable[[BaseException | None], Awaitable[None]] | None
+    max_attempts: int
+    traffic: str
+    attempt: int = 1  # сколько попыток уже сделано
+
+
+@dataclass
+class DeadLetter:
+    name: str
+    error: str
+    attempts: int
+    at: datetime = field(default_factory=datetime.utcnow)
+
+
+class RetryQueue:
+    """
+    Отложенные повторы запросов, упавших на временной ошибке.
+    Задачи лежат в куче по времени следующей попытки; задержка растёт экспоненциально
+    (base * 2^n, не больше max_delay) со случайным разбросом, чтобы повторы не шли пачкой.
+    Исчерпавшие попытки попадают в dead letter — его смотрит админ.
+    Постоянные ошибки (бот заблокирован, неверный запрос) не повторяются и в dead letter не попадают.
+    """
+
+    def __init__(self, max_attempts: int = RETRY_MAX_ATTEMPTS, base_delay: float = RETRY_BASE_DELAY,
+                 max_delay: float = RETRY_MAX_DELAY, dead_letter_size: int = RETRY_DEAD_LETTER_SIZE):
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.dead_letters: deque[DeadLetter] = deque(maxlen=dead_letter_size)
+        self._heap: list[tuple[float, int, RetryItem]] = []
+        self._seq = itertools.count()
+        self._wakeup = asyncio.Event()
+        self._task: asyncio.Task | None = None
+        self._running: set[asyncio.Task] = set()
+
+    def __len__(self):
+        return len(self._heap) + len(self._running)
+
+    def backoff(self, attempt: int) -> float:
+        """Задержка перед попыткой attempt + 1: экспонента с разбросом 50–100%"""
+        delay = min(self.max_delay, self.base_delay * 2 ** (attempt - 1))
+        return delay * random.uniform(0.5, 1.0)
+
+    def _schedule(self, item: RetryItem):
+        due = time.monotonic() + self.backoff(item.attempt)
+        heapq.heappush(self._heap, (due, next(self._seq), item))
+        self._wakeup.set()
+
+    def submit(self, name: str, call: Callable[[], Awaitable],
+               on_done: Callable[[BaseException | None], Awaitable[None]] | None = None,
+               max_attempts: int | None = None):
+        """
+        Ставит повтор call() после уже неудачной первой попытки.
+        on_done(error) вызывается один раз с итогом: None — доставлено, иначе последняя ошибка.
+        """
+        self._schedule(RetryItem(name, call, on_done, max_attempts or self.max_attempts, traffic.get()))
+
+    async def run(self, name: str, call: Callable[[], Awaitable], **kwargs):
+        """Выполняет call() сразу; при временной ошибке ставит повтор, постоянную пробрасывает"""
+        try:
+            return await call()
+        except Exception as e:
+            if not is_transient(e):
+                raise
+            logger.warning(f"🔁 {name}: {e!r}, повтор позже")
+            self.submit(name, call, **kwargs)
+
+    async def _attempt(self, item: RetryItem):
+        traffic.set(item.traffic)
+        item.attempt += 1
+        try:
+            await item.call()
+        except Exception as e:
+            if is_transient(e) and item.attempt < item.max_attempts:
+                self._schedule(item)
+                return
+            if is_transient(e):
+                logger.error(f"☠️ {item.name}: не доставлено после {item.attempt} попыток: {e!r}")
+                self.dead_letters.append(DeadLetter(item.name, repr(e)[:255], item.attempt))
+            await self._done(item, e)
+            return
+        logger.info(f"✅ {item.name}: доставлено с попытки {item.attempt}")
+        await self._done(item, None)
+
+    async def _done(self, item: RetryItem, error: BaseException | None):
+        if item.on_done:
+            try:
+                await item.on_done(error)
+            except Exception as e:
+                logger.error(f"Ошибка обработки итога повтора {item.name}: {e}")
+
+    async def _run(self):
+        while True:
+            self._wakeup.clear()
+            if not self._heap:
+                await self._wakeup.wait()
+                continue
+            delay = self._heap[0][0] - time.monotonic()
+            if delay > 0:
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), timeout=delay)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            _, _, item = heapq.heappop(self._heap)
+            task = asyncio.create_task(self._attempt(item))
+            self._running.add(task)
+            task.add_done_callback(self._running.discard)
+
+    def start(self):
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+        await asyncio.gather(*self._running, return_exceptions=True)
+        if self._heap:
+            logger.warning(f"⚠️ Остановка: не выполнено отложенных повторов: {len(self._heap)}")
+        # Куча живёт только в памяти: сообщаем владельцам итог, чтобы они записали недоставку
+        # (рассылка уже сдвинула курсор за этих получателей и после рестарта их не повторит)
+        heap, self._heap = self._heap, []
+        for _, _, item in heap:
+            await self._done(item, RetryAbandoned(f"повтор не выполнен до остановки бота (попыток: {item.attempt})"))
+
+
+retry_queue = RetryQueue()
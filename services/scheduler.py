@@ -0,0 +1,111 @@
+import asyncio
+import logging
+import re
+from datetime import datetime, timedelta
+
+from sqlalchemy import select, update, func
+
+from config import SCHEDULER_INTERVAL, SCHEDULE_UTC_OFFSET
+from database.database import async_session, BroadcastJob
+from services.broadcast_manager import broadcast_manager
+
+logger = logging.getLogger(__name__)
+
+LOCAL_OFFSET = timedelta(hours=SCHEDULE_UTC_OFFSET)
+TIME_RE = re.compile(r"^(?:(\d{1,2})\.(\d{1,2})\s+)?(\d{1,2}):(\d{2})$")
+
+
+def parse_local_time(text: str, now: datetime | None = None) -> datetime | None:
+    """
+    "ЧЧ:ММ" (ближайшее такое время) или "ДД.ММ ЧЧ:ММ" в часовом поясе админа -> UTC.
+    None, если формат не распознан или время уже прошло.
+    """
+    match = TIME_RE.match(text.strip())
+    if not match:
+        return None
+    day, month, hour, minute = match.groups()
+    now_local = (now or datetime.utcnow()) + LOCAL_OFFSET
+    try:
+        if day:
+            local = now_local.replace(month=int(month), day=int(day), hour=int(hour), minute=int(minute),
+                                      second=0, microsecond=0)
+            if local < now_local:
+                local = local.replace(year=local.year + 1)
+        else:
+            local = now_local.replace(hour=int(hour), minute=int(minute), second=0, microsecond=0)
+            if local <= now_local:
+                local += timedelta(days=1)
+    except ValueError:
+        return None
+    return local - LOCAL_OFFSET
+
+
+def format_local_time(utc: datetime) -> str:
+    return f"{utc + LOCAL_OFFSET:%d.%m %H:%M}"
+
+
+class BroadcastScheduler:
+    """
+    Запускает отложенные рассылки: раз в interval секунд ищет в broadcast_jobs
+    задачи со статусом scheduled, чьё время наступило (или просыпается раньше — к ближайшей
+    задаче и по wake() при создании новой). Расписание хранится в таблице,
+    поэтому переживает перезапуск. Задача забирается условным UPDATE, так что
+    один и тот же запуск не выполнится дважды.
+    """
+
+    def __init__(self, interval: float = SCHEDULER_INTERVAL):
+        self.interval = interval
+        self._wakeup = asyncio.Event()
+
+    def wake(self):
+        """Перечитать расписание сейчас, не дожидаясь интервала (вызывается при создании задачи)"""
+        self._wakeup.set()
+
+    async def _next_delay(self) -> float:
+        """Сколько ждать до следующей проверки: до ближайшей задачи, но не дольше interval"""
+        async with async_session() as db:
+            next_at = await db.scalar(
+                select(func.min(BroadcastJob.scheduled_at)).where(BroadcastJob.status == "scheduled")
+            )
+        if next_at is None:
+            return self.interval
+        # Не чаще раза в секунду, чтобы не крутиться, если задача не забирается
+        return min(self.interval, max(1.0, (next_at - datetime.utcnow()).total_seconds()))
+
+    async def run_due(self, bot):
+        async with async_session() as db:
+            jobs = (await db.execute(
+                select(BroadcastJob.id, BroadcastJob.admin_chat_id).where(
+                    BroadcastJob.status == "scheduled",
+                    BroadcastJob.scheduled_at <= datetime.utcnow()
+                ).order_by(BroadcastJob.scheduled_at)
+            )).all()
+        for job_id, admin_chat_id in jobs:
+            async with async_session() as db:
+                claimed = await db.execute(
+                    update(BroadcastJob)
+                    .where(BroadcastJob.id == job_id, BroadcastJob.status == "scheduled")
+                    .values(status="running")
+                )
+                await db.commit()
+            if not claimed.rowcount:
+                continue
+            logger.info(f"🕒 Запуск отложенной рассылки #{job_id}")
+            await broadcast_manager.start(bot, job_id, admin_chat_id)
+
+    async def run(self, bot):
+        while True:
+            delay = self.interval
+            try:
+                await self.run_due(bot)
+                delay = await self._next_delay()
+            except Exception as e:
+                logger.error(f"Ошибка планировщика рассылок: {e}")
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=delay)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+
+
+scheduler = BroadcastScheduler()
@@ -0,0 +1,128 @@
+import asyncio
+import logging
+import multiprocessing
+
+from aiogram import Bot, Dispatcher
+from aiogram.types import Update
+
+from services import invalidation
+
+logger = logging.getLogger(__name__)
+
+# Long polling getUpdates (сек)
+LONG_POLL_TIMEOUT = 30
+
+
+def jump_hash(key: int, buckets: int) -> int:
+    """Jump consistent hash (Lamping, Veach): ключ -> номер воркера в [0, buckets)"""
+    key &= 0xFFFFFFFFFFFFFFFF
+    b, j = -1, 0
+    while j < buckets:
+        b = j
+        key = (key * 2862933555777941757 + 1) & 0xFFFFFFFFFFFFFFFF
+        j = int((b + 1) * ((1 << 31) / ((key >> 33) + 1)))
+    return b
+
+
+def routing_key(update: Update) -> int:
+    """Пользователь, к которому относится апдейт: все его апдейты уходят в один воркер"""
+    event = update.event
+    if update.chat_member or update.my_chat_member:
+        return event.new_chat_member.user.id
+    user = getattr(event, "from_user", None)
+    if user:
+        return user.id
+    chat = getattr(event, "chat", None)
+    return chat.id if chat else 0
+
+
+# --- Воркер ---
+
+def worker_main(index: int, inbox, events):
+    """Точка входа процесса-воркера"""
+    logging.basicConfig(level=logging.INFO)
+    asyncio.run(_worker(index, inbox, events))
+
+
+async def _worker(index: int, inbox, events):
+    from loader import dp, create_bot, start_services, stop_services
+
+    bot = create_bot()
+    invalidation.set_publisher(lambda kind: events.put((index, kind)))
+    # Незавершённые рассылки возобновляет только первый воркер
+    await start_services(bot, resume_broadcasts=index == 0)
+    logger.info(f"👷 Воркер {index} запущен")
+
+    loop = asyncio.get_running_loop()
+    try:
+        while True:
+            kind, payload = await loop.run_in_executor(None, inbox.get)
+            if kind == "stop":
+                break
+            if kind == "invalidate":
+                await invalidation.apply(payload)
+                continue
+            # Апдейт только ставится в очередь пользователя (UserLanes), ожидание — при переполнении очередей
+            await dp.feed_raw_update(bot, payload)
+    finally:
+        await stop_services()
+        await bot.session.close()
+        logger.info(f"👷 Воркер {index} остановлен")
+
+
+# --- Родительский процесс ---
+
+async def _fan_out(events, inboxes):
+    """Рассылает события инвалидации кэшей всем воркерам, кроме источника"""
+    loop = asyncio.get_running_loop()
+    while True:
+        source, kind = await loop.run_in_executor(None, events.get)
+        if source is None:
+            return
+        for index, inbox in enumerate(inboxes):
+            if index != source:
+                inbox.put(("invalidate", kind))
+
+
+async def run_sharded_polling(bot: Bot, dp: Dispatcher, workers: int):
+    """
+    Родитель читает getUpdates и раздаёт апдейты N процессам по consistent hash
+    от id пользователя, поэтому FSM одного пользователя живёт в одном процессе.
+    """
+    ctx = multiprocessing.get_context("spawn")
+    events = ctx.Queue()
+    inboxes = [ctx.Queue() for _ in range(workers)]
+    processes = [
+        ctx.Process(target=worker_main, args=(index, inbox, events), daemon=True)
+        for index, inbox in enumerate(inboxes)
+    ]
+    for process in processes:
+        process.start()
+    fan_out = asyncio.create_task(_fan_out(events, inboxes))
+
+    allowed_updates = dp.resolve_used_update_types()
+    offset = None
+    logger.info(f"🔀 Запущено воркеров: {workers}")
+    try:
+        while True:
+            try:
+                # Как в aiogram: HTTP-таймаут больше long poll, иначе каждый пустой опрос обрывается по таймауту сессии
+                updates = await bot.get_updates(offset=offset, timeout=LONG_POLL_TIMEOUT,
+                                                allowed_updates=allowed_updates,
+                                                request_timeout=int(bot.session.timeout + LONG_POLL_TIMEOUT))
+            except Exception as e:
+                logger.error(f"Ошибка getUpdates: {e}")
+                await asyncio.sleep(1)
+                continue
+            for update in updates:
+                offset = update.update_id + 1
+                inbox = inboxes[jump_hash(routing_key(update), workers)]
+                inbox.put(("update", update.model_dump(mode="json", by_alias=True, exclude_unset=True)))
+    finally:
+        for inbox in inboxes:
+            inbox.put(("stop", None))
+        events.put((None, None))
+        await fan_out
+        loop = asyncio.get_running_loop()
+        for process in processes:
+            await loop.run_in_executor(None, process.join)
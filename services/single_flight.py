@@ -0,0 +1,41 @@
+import time
+from typing import Any, Awaitable, Callable, Hashable
+
+
+class SingleFlight:
+    """
+    Схлопывание повторных вызовов по ключу: нажатие, пришедшее во время вызова
+    или в течение cooldown секунд после его завершения, получает тот же результат.
+    Одновременных вызовов по одному ключу не бывает — апдейты пользователя выполняются
+    по очереди (services.dispatch.UserLanes), поэтому повторы ждут в его очереди,
+    а время сравнивается по моменту поступления апдейта, а не начала обработки:
+    иначе нажатия, простоявшие в очереди за долгой проверкой, запускали бы её заново.
+    Ошибки не кэшируются — следующий вызов выполнится заново.
+    """
+
+    def __init__(self, cooldown: float):
+        self.cooldown = cooldown
+        self._recent: dict[Hashable, tuple[float, Any]] = {}  # ключ -> (время завершения, результат)
+        self.coalesced = 0
+
+    async def run(self, key: Hashable, factory: Callable[[], Awaitable[Any]],
+                  received_at: float | None = None) -> Any:
+        """received_at — time.monotonic() поступления апдейта (по умолчанию — сейчас)"""
+        if received_at is None:
+            received_at = time.monotonic()
+        recent = self._recent.get(key)
+        if recent and received_at - recent[0] < self.cooldown:
+            self.coalesced += 1
+            return recent[1]
+
+        result = await factory()
+        now = time.monotonic()
+        self._recent.pop(key, None)
+        self._recent[key] = (now, result)
+        # Записи идут по времени завершения: устаревшие всегда в начале словаря
+        while self._recent:
+            old_key = next(iter(self._recent))
+            if now - self._recent[old_key][0] < self.cooldown:
+                break
+            del self._recent[old_key]
+        return result
@@ -0,0 +1,64 @@
+import asyncio
+import logging
+
+from sqlalchemy import select
+
+from database.database import async_session, Message
+from services.personalize import Template, compile_template
+from services.render import entities_to_html
+
+logger = logging.getLogger(__name__)
+
+
+class TemplateRegistry:
+    """
+    Кэш текстов из таблицы messages, уже сконвертированных в HTML и разобранных
+    на сегменты с подстановками ({first_name}, {username}).
+    Хендлеры рендерят готовый шаблон по title без запросов к БД.
+    """
+
+    def __init__(self):
+        self._templates: dict[str, Template] = {}
+
+    async def load(self):
+        """Загружает (или перезагружает) все сообщения из БД одной выборкой"""
+        async with async_session() as db:
+            messages = (await db.scalars(select(Message))).all()
+        # Собираем новый словарь целиком и подменяем одной операцией,
+        # чтобы читатели никогда не видели частично заполненный кэш
+        self._templates = {m.title: Template(entities_to_html(m.text, m.entities)) for m in messages}
+        logger.info(f"✅ Загружено шаблонов сообщений: {len(self._templates)}")
+
+    reload = load
+
+    def get(self, title: str, default: str | None = None) -> str | None:
+        """HTML шаблона без подстановок"""
+        template = self._templates.get(title)
+        return template.source if template else default
+
+    def render(self, title: str, user, default: str | None = None) -> str | None:
+        """HTML шаблона с данными пользователя; default — тоже шаблон, на случай если title нет в БД"""
+        template = self._templates.get(title)
+        if template is None:
+            if default is None:
+                return None
+            template = compile_template(default)
+        return template.render_for(user)
+
+    def update(self, title: str, text: str, entities: list | None):
+        """Обновляет один шаблон после редактирования (copy-on-write)"""
+        templates = dict(self._templates)
+        templates[title] = Template(entities_to_html(text, entities))
+        self._templates = templates
+
+    async def run_reloader(self, interval: float):
+        """Периодическая перезагрузка — для нескольких процессов, редактирующих одну БД"""
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                await self.reload()
+            except Exception as e:
+                logger.error(f"Ошибка перезагрузки шаблонов: {e}")
+
+
+templates = TemplateRegistry()
@@ -0,0 +1,21 @@
+from aiogram import Bot, Dispatcher
+from aiogram.webhook.aiohttp_server import SimpleRequestHandler, setup_application
+from aiohttp import web
+
+from config import WEBHOOK_PATH, WEBHOOK_SECRET
+
+
+def create_webhook_app(dp: Dispatcher, bot: Bot) -> web.Application:
+    """
+    aiohttp-приложение с диспетчером на WEBHOOK_PATH и проверкой X-Telegram-Bot-Api-Secret-Token.
+    Апдейт обрабатывается в запросе, но диспетчер только ставит его в очередь UserLanes
+    и сразу возвращается, так что Telegram получает 200 без ожидания хендлера.
+    Параллельность задаёт UPDATE_WORKERS, а когда в очередях UPDATE_MAX_PENDING апдейтов,
+    ответ задерживается и Telegram придерживает следующие апдейты у себя.
+    """
+    app = web.Application()
+    SimpleRequestHandler(
+        dp, bot, handle_in_background=False, secret_token=WEBHOOK_SECRET or None
+    ).register(app, path=WEBHOOK_PATH)
+    setup_application(app, dp, bot=bot)
+    return app
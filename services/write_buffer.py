@@ -0,0 +1,147 @@
+import asyncio
+import logging
+
+from sqlalchemy import delete
+
+from config import WRITE_BUFFER_FLUSH_SIZE, WRITE_BUFFER_FLUSH_INTERVAL
+from database.database import async_session, PendingRequest, upsert_users, add_pending_requests
+
+logger = logging.getLogger(__name__)
+
+# Строк в одном многострочном INSERT (лимит параметров у SQLite/Postgres)
+INSERT_CHUNK = 500
+
+
+class WriteBehindBuffer:
+    """
+    Буфер отложенной записи для /start и заявок на вступление.
+    Хендлеры только кладут строки в память, фоновая задача пишет их
+    многострочными upsert'ами по размеру пачки или по таймеру.
+    Чтения (проверка подписки) учитывают ещё не записанные заявки,
+    в том числе из пачки, которая прямо сейчас пишется в БД.
+    """
+
+    def __init__(self, flush_size: int = WRITE_BUFFER_FLUSH_SIZE, flush_interval: float = WRITE_BUFFER_FLUSH_INTERVAL):
+        self.flush_size = flush_size
+        self.flush_interval = flush_interval
+        self._users: dict[int, dict] = {}
+        self._pending: dict[int, set[int]] = {}  # user_id -> {chat_id}
+        self._pending_count = 0
+        self._inflight_pending: dict[int, set[int]] = {}  # заявки пачки, которая пишется сейчас
+        self._lock = asyncio.Lock()
+        self._wakeup = asyncio.Event()
+        self._task: asyncio.Task | None = None
+
+    def __len__(self):
+        return len(self._users) + self._pending_count
+
+    def _added(self):
+        if len(self) >= self.flush_size:
+            self._wakeup.set()
+
+    def add_user(self, user_id: int, username: str, first_name: str):
+        self._users[user_id] = {"user_id": user_id, "username": username, "first_name": first_name}
+        self._added()
+
+    def add_pending_request(self, user_id: int, chat_id: int):
+        chats = self._pending.setdefault(user_id, set())
+        if chat_id not in chats:
+            chats.add(chat_id)
+            self._pending_count += 1
+            self._added()
+
+    def pending_chat_ids(self, user_id: int) -> set[int]:
+        """Заявки пользователя, ещё не закоммиченные в БД"""
+        buffered = self._pending.get(user_id, set())
+        inflight = self._inflight_pending.get(user_id)
+        return buffered | inflight if inflight else buffered
+
+    def _discard_pending(self, user_id: int, chat_id: int):
+        chats = self._pending.get(user_id)
+        if chats and chat_id in chats:
+            chats.discard(chat_id)
+            self._pending_count -= 1
+            if not chats:
+                del self._pending[user_id]
+
+    def _discard_inflight(self, user_id: int, chat_id: int) -> bool:
+        chats = self._inflight_pending.get(user_id)
+        if not chats or chat_id not in chats:
+            return False
+        chats.discard(chat_id)
+        if not chats:
+            del self._inflight_pending[user_id]
+        return True
+
+    async def delete_pending_request(self, user_id: int, chat_id: int) -> int:
+        """
+        Удаляет заявку и из буфера, и из БД. Лок flush берётся, только если заявка
+        в пачке, которая сейчас пишется: удалять её из БД нужно после коммита пачки,
+        иначе пачка вернёт удалённую заявку.
+        """
+        self._discard_pending(user_id, chat_id)
+        if self._discard_inflight(user_id, chat_id):
+            async with self._lock:
+                pass
+        async with async_session() as db:
+            result = await db.execute(delete(PendingRequest).where(
+                PendingRequest.user_id == user_id,
+                PendingRequest.chat_id == chat_id
+            ))
+            await db.commit()
+        return result.rowcount
+
+    async def flush(self):
+        async with self._lock:
+            if not len(self):
+                return
+            users = list(self._users.values())
+            pending = [
+                {"user_id": user_id, "chat_id": chat_id}
+                for user_id, chats in self._pending.items()
+                for chat_id in chats
+            ]
+            # До коммита заявки пачки остаются видны pending_chat_ids
+            self._inflight_pending = self._pending
+            self._users, self._pending, self._pending_count = {}, {}, 0
+            try:
+                async with async_session() as db:
+                    for i in range(0, len(users), INSERT_CHUNK):
+                        await upsert_users(db, users[i:i + INSERT_CHUNK])
+                    for i in range(0, len(pending), INSERT_CHUNK):
+                        await add_pending_requests(db, pending[i:i + INSERT_CHUNK])
+                    await db.commit()
+            except Exception as e:
+                logger.error(f"Ошибка записи буфера (польз.: {len(users)}, заявок: {len(pending)}): {e}")
+                # Возвращаем строки в буфер, более свежие данные не перетираем
+                for row in users:
+                    self._users.setdefault(row["user_id"], row)
+                # Заявки, удалённые во время записи, из _inflight_pending уже убраны
+                for user_id, chats in self._inflight_pending.items():
+                    for chat_id in chats:
+                        self.add_pending_request(user_id, chat_id)
+            finally:
+                self._inflight_pending = {}
+
+    async def _run(self):
+        while True:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            await self.flush()
+
+    def start(self):
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        """Останавливает фоновую запись и сбрасывает остаток буфера в БД"""
+        if self._task:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+        await self.flush()
+
+
+write_buffer = WriteBehindBuffer()
@@ -0,0 +1,54 @@
+import asyncio
+import datetime
+import os
+import sys
+
+os.environ.setdefault("BOT_TOKEN", "42:TEST")
+os.environ.setdefault("DATABASE_URL", "sqlite://")
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from aiogram import Bot, Dispatcher, Router  # noqa: E402
+from aiogram.filters import StateFilter  # noqa: E402
+from aiogram.fsm.context import FSMContext  # noqa: E402
+from aiogram.fsm.storage.memory import MemoryStorage  # noqa: E402
+from aiogram.types import Chat, Message, Update, User  # noqa: E402
+
+from services.dispatch import UserLanes  # noqa: E402
+
+
+def message_update(update_id: int, text: str) -> Update:
+    return Update(update_id=update_id, message=Message(
+        message_id=update_id, date=datetime.datetime.now(), chat=Chat(id=7, type="private"),
+        from_user=User(id=7, is_bot=False, first_name="u"), text=text
+    ))
+
+
+def test_queued_update_sees_state_set_by_previous_one():
+    """Второе сообщение, ждавшее в очереди пользователя, маршрутизируется по уже новому состоянию"""
+    handled = []
+    router = Router()
+
+    @router.message(StateFilter(None))
+    async def start_flow(message: Message, state: FSMContext):
+        await asyncio.sleep(0.01)
+        await state.set_state("waiting")
+        handled.append(("start", message.text))
+
+    @router.message(StateFilter("waiting"))
+    async def receive(message: Message, state: FSMContext):
+        await state.clear()
+        handled.append(("waiting", message.text))
+
+    async def run():
+        lanes = UserLanes(workers=10, max_pending=100)
+        dp = Dispatcher(storage=MemoryStorage())
+        dp.include_router(router)
+        dp.update.outer_middleware(lanes)
+        bot = Bot("42:TEST")
+        await dp.feed_update(bot, message_update(1, "add_channel"))
+        await dp.feed_update(bot, message_update(2, "-1001234567890"))
+        await lanes.drain()
+        await bot.session.close()
+
+    asyncio.run(run())
+    assert handled == [("start", "add_channel"), ("waiting", "-1001234567890")]